@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2020 MIT
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+import simulator
+from networkEditor import Network
+from networkEditor import Simulation
+from networkEditor import Switch
+from networkEditor import Host
+from networkEditor import Link
+from networkEditor import addAccelerators
+from networkEditor import DEFAULT_BW_NVLINK
+from planCompiler import CompiledPlan
+from profile import Profile
+
+# Benchmarks of the simulator on synthetic plans & topologies.
+# Each phase is timed separately: network construction, path computation,
+# task-graph build (plan compilation included) and Simulation.run().
+#
+# Usage:
+#   ./benchmark.py                           # run the default suite and print results.
+#   ./benchmark.py --save bench_baseline.json
+#   ./benchmark.py --compare bench_baseline.json
+
+DEFAULT_SUITE = [
+    # layers, replicas per stage, hosts, gpus per host, iterations.
+    # "iterations" independent training iterations (each with its own gradient all-reduce & optimizer
+    # step) are built into one task graph to scale up the event count. They are not pipelined microbatches.
+    {"layers": 16,  "replicas": 1, "hosts": 1,  "gpusPerHost": 4, "iterations": 1},
+    {"layers": 64,  "replicas": 2, "hosts": 2,  "gpusPerHost": 4, "iterations": 4},
+    {"layers": 128, "replicas": 4, "hosts": 4,  "gpusPerHost": 8, "iterations": 8},
+    {"layers": 256, "replicas": 8, "hosts": 16, "gpusPerHost": 8, "iterations": 8},
+]
+REGRESSION_THRESHOLD = 1.25 # Flag a phase when it's slower than baseline by this factor.
+MIN_SECONDS_TO_COMPARE = 0.001 # Shorter phases are too noisy to compare.
+LOCAL_BATCH = 32
+BYTES_PER_SAMPLE = 1 << 20
+
+##########################################################################
+# Synthetic generators
+##########################################################################
+# Same topology as buildAwsP3Network(), but without calcShortestPath() so that it can be timed separately.
+def buildSyntheticNetwork(hostCount, gpusPerHost, hostToTorBw=100, hostToTorLat=10):
+    net = Network()
+    rootSw = Switch(net)
+    for i in range(hostCount):
+        host = Host(net)
+        Link(net, rootSw, host, hostToTorBw, hostToTorLat)
+        Link(net, host, rootSw, hostToTorBw, hostToTorLat)
+        addAccelerators(net, host, gpusPerHost, DEFAULT_BW_NVLINK)
+    return net
+
+# Sequential layers split into pipeline stages as evenly as possible. Each stage is
+# data-parallel over `replicas` consecutive accelerators.
+def buildSyntheticPlan(numLayers, replicas, numAccelerators, localBatch=LOCAL_BATCH,
+                       bytesPerSample=BYTES_PER_SAMPLE):
+    numStages = max(1, min(numLayers, numAccelerators // replicas))
+    plan = []
+    for i in range(numLayers):
+        stage = i * numStages // numLayers
+        assigned = [{"id": stage * replicas + r + 1, "localBatch": localBatch} for r in range(replicas)]
+        prevLayers = [] if i == 0 else [{"LayerId": i, "InputBytesPerSample": bytesPerSample}]
+        plan.append({"layerId": i + 1, "name": "layer%d" % (i + 1), "modelBytes": 4 * bytesPerSample,
+                     "prevLayers": prevLayers, "assignedAccelerators": assigned})
+    return plan
+
+# Compute time grows linearly with the local batch, at every power-of-two batch size up to maxBatch.
+def buildSyntheticProfile(numLayers, maxBatch=1024):
+    profile = Profile()
+    batches = []
+    batch = 1
+    while batch <= maxBatch:
+        batches.append(batch)
+        batch *= 2
+    for layerId in range(1, numLayers + 1):
+        perSample = 1.0 + (layerId % 7)
+        profile.setDatapoints(layerId, batches, [[10 + perSample * b for b in batches],
+                                                 [20 + 2 * perSample * b for b in batches]])
+    return profile
+
+##########################################################################
+# Benchmark runner
+##########################################################################
+def runPhases(config):
+    phases = {}
+    t = time.perf_counter()
+    net = buildSyntheticNetwork(config["hosts"], config["gpusPerHost"])
+    phases["networkConstruction"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    net.calcShortestPath()
+    phases["pathComputation"] = time.perf_counter() - t
+
+    profiles = {"V100": buildSyntheticProfile(config["layers"])}
+    trainingPlan = buildSyntheticPlan(config["layers"], config["replicas"], len(net.accelerators))
+    t = time.perf_counter()
+    plan = CompiledPlan(trainingPlan, net)
+    sim = Simulation(net)
+    for i in range(config["iterations"]):
+        simulator.buildTaskGraph(sim, plan, profiles)
+    phases["taskGraphBuild"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    sim.run()
+    phases["simulationRun"] = time.perf_counter() - t
+    events = len(sim.compTasks) + len(sim.linkTasks)
+    return phases, events
+
+def runBenchmark(config, repeat, measureMemory):
+    best = None
+    for i in range(repeat):
+        phases, events = runPhases(config)
+        if best is None:
+            best = phases
+        else:
+            best = {k: min(best[k], phases[k]) for k in phases}
+    result = dict(config)
+    result["seconds"] = best
+    result["events"] = events
+    result["eventsPerSec"] = events / best["simulationRun"] if best["simulationRun"] > 0 else 0
+
+    # tracemalloc slows everything down, so memory is measured in a separate run.
+    if measureMemory:
+        tracemalloc.start()
+        runPhases(config)
+        result["peakMemoryBytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+# Returns list of (configName, phase, ratio) that got slower than the baseline.
+def findRegressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+    def name(r):
+        return "L%d_R%d_H%d_G%d_I%d" % (r["layers"], r["replicas"], r["hosts"], r["gpusPerHost"], r["iterations"])
+    baselineByName = {name(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        if name(r) not in baselineByName:
+            continue
+        old = baselineByName[name(r)]
+        for phase, seconds in r["seconds"].items():
+            oldSeconds = old["seconds"].get(phase, 0)
+            if oldSeconds >= MIN_SECONDS_TO_COMPARE and seconds / oldSeconds > threshold:
+                regressions.append((name(r), phase, seconds / oldSeconds))
+        if "peakMemoryBytes" in r and old.get("peakMemoryBytes", 0) > 0 and \
+                r["peakMemoryBytes"] / old["peakMemoryBytes"] > threshold:
+            regressions.append((name(r), "peakMemoryBytes", r["peakMemoryBytes"] / old["peakMemoryBytes"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks simulator scaling on synthetic plans.")
+    parser.add_argument("--save", help="write results to this baseline file (JSON).")
+    parser.add_argument("--compare", help="compare results against this baseline file; exits 1 on regression.")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per configuration; the fastest is reported.")
+    parser.add_argument("--no-memory", action="store_true", help="skip peak memory measurement.")
+    parser.add_argument("--quick", action="store_true", help="run only the smaller half of the suite.")
+    args = parser.parse_args()
+
+    simulator.VERBOSE = False
+    Simulation.VERBOSE = False
+    suite = DEFAULT_SUITE[:len(DEFAULT_SUITE) // 2] if args.quick else DEFAULT_SUITE
+
+    results = []
+    print("# layers replicas hosts gpus  iters |   network     paths taskGraph       run (sec) |   events  events/sec  peakMem(MB)")
+    for config in suite:
+        r = runBenchmark(config, args.repeat, not args.no_memory)
+        results.append(r)
+        sec = r["seconds"]
+        print("%8d %8d %5d %4d %6d | %9.4f %9.4f %9.4f %9.4f       | %8d %11.0f %12.1f"
+              % (r["layers"], r["replicas"], r["hosts"], r["gpusPerHost"], r["iterations"],
+                 sec["networkConstruction"], sec["pathComputation"], sec["taskGraphBuild"], sec["simulationRun"],
+                 r["events"], r["eventsPerSec"], r.get("peakMemoryBytes", 0) / 1e6))
+
+    output = {"python": platform.python_version(), "machine": platform.machine(), "results": results}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = findRegressions(results, json.load(f))
+        for configName, phase, ratio in regressions:
+            print("REGRESSION %s %s: %.2fx of baseline" % (configName, phase, ratio))
+        if len(regressions) > 0:
+            exit(1)
+
+if __name__ == "__main__":
+    main()
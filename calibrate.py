@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2020 MIT
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import argparse
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+import simulator
+from networkEditor import Simulation
+from networkEditor import applyCalibration
+from networkEditor import buildNetworkFromConfig
+from networkEditor import getLinkClass
+from networkEditor import LINK_CLASSES
+from planCompiler import compilePlan
+from profile import Profile
+
+# Fits link bandwidth & latency scales per link class and compute scales per accelerator model
+# to measured iteration times.
+#
+# Usage:
+#   ./calibrate.py records.json calibration.json --profile V100=profile_pipedream/P100/profile.json
+#   ./simulator.py <profile> <plan> calibration.json
+#
+# records.json is a list of measurements:
+#   [{"plan": "path/to/plan.json" or [...], "network": {...} (see networkEditor.buildNetworkFromConfig),
+#     "iterationTime": <measured microseconds>, "profiles": {"V100": "path"} (optional)}, ...]
+#
+# The task graph of each record is built once per worker process. Each evaluation only sets the
+# per-run link parameters of the Simulation and the times of profiled compute tasks, then reset()
+# & run(). Candidate moves of a coordinate search are evaluated in parallel, one candidate per task.
+# Compute scales apply to profiled layer times only, as Profile.computeScale does; optimizer steps
+# keep their time. The result is re-simulated from the calibration as written to the file, and the
+# error of that run is reported next to the fitted error.
+
+INITIAL_STEP = 2.0      # First multiplicative step of each parameter.
+MIN_STEP = 1.01         # Search stops when every step is below this.
+MAX_ROUNDS = 200
+MIN_SCALE = 1e-3
+MAX_SCALE = 1e3
+ROUND_TRIP_TOLERANCE = 1e-6 # Max. difference between fitted & re-simulated errors.
+
+##########################################################################
+# Parameters
+##########################################################################
+# Parameters are {name: scale}, with names "bw:<linkClass>", "lat:<linkClass>" and "compute:<model>".
+def getParamNames(linkClasses, models):
+    names = []
+    for c in LINK_CLASSES:
+        if c in linkClasses:
+            names += ["bw:" + c, "lat:" + c]
+    names += ["compute:" + m for m in sorted(models)]
+    return names
+
+def toCalibration(params):
+    calibration = {"links": {}, "computeScale": {}}
+    for name, scale in params.items():
+        kind, key = name.split(":", 1)
+        if kind == "compute":
+            calibration["computeScale"][key] = scale
+        else:
+            calibration["links"].setdefault(key, {})["bwScale" if kind == "bw" else "latScale"] = scale
+    return calibration
+
+##########################################################################
+# Evaluation. Runs in worker processes.
+##########################################################################
+# Profiles are cached per (model, path): models sharing a file still get their own Profile,
+# since each model gets its own computeScale.
+def loadRecordProfiles(record, defaultProfilePaths, profileCache):
+    profiles = {}
+    for model, path in record.get("profiles", defaultProfilePaths).items():
+        if (model, path) not in profileCache:
+            profileCache[(model, path)] = Profile(path)
+        profiles[model] = profileCache[(model, path)]
+    return profiles
+
+def loadRecordPlan(record):
+    if isinstance(record["plan"], str):
+        with open(record["plan"]) as f:
+            return json.load(f)
+    return record["plan"]
+
+class CalibrationRecord:
+    def __init__(self, record, defaultProfilePaths, profileCache):
+        self.measured = record["iterationTime"]
+        self.net = buildNetworkFromConfig(record["network"])
+        profiles = loadRecordProfiles(record, defaultProfilePaths, profileCache)
+        self.sim = Simulation(self.net)
+        optimizerTasks = set(simulator.buildTaskGraph(self.sim, compilePlan(loadRecordPlan(record), self.net), profiles))
+        self.linkClasses = [getLinkClass(self.net, link) for link in self.net.links]
+        # [(task, unscaled time, model), ...] of compute tasks whose time comes from a profile.
+        self.profiledTasks = [(t, t.computeTime, self.net.elements[t.acceleratorGuid].model)
+                              for t in self.sim.compTasks if t not in optimizerTasks and t.computeTime > 0]
+
+    def predict(self, params):
+        sim = self.sim
+        sim.reset()
+        sim.linkBw = [link.bw * params.get("bw:" + c, 1.0) for link, c in zip(self.net.links, self.linkClasses)]
+        sim.linkLat = [link.lat * params.get("lat:" + c, 1.0) for link, c in zip(self.net.links, self.linkClasses)]
+        for task, computeTime, model in self.profiledTasks:
+            task.computeTime = computeTime * params.get("compute:" + model, 1.0)
+        sim.run()
+        return sim.getCompletionTime()
+
+workerRecords = None
+
+def initWorker(records, defaultProfilePaths):
+    global workerRecords
+    simulator.VERBOSE = False
+    Simulation.VERBOSE = False
+    profileCache = {}
+    workerRecords = [CalibrationRecord(r, defaultProfilePaths, profileCache) for r in records]
+
+# Mean squared log error, so that over- and under-prediction by the same factor count the same.
+def evaluate(params):
+    total = 0
+    for record in workerRecords:
+        total += math.log(record.predict(params) / record.measured) ** 2
+    return total / len(workerRecords)
+
+##########################################################################
+# Search
+##########################################################################
+# Multiplicative coordinate search. In each round, every parameter is moved up & down by its step
+# in parallel and the best improving move is taken. A parameter's step shrinks when neither move helps.
+def calibrate(records, defaultProfilePaths = None, workers = None, verbose = False):
+    # Link classes & models present in the records.
+    simulator.VERBOSE = False
+    Simulation.VERBOSE = False
+    linkClasses = set()
+    models = set()
+    for r in records:
+        net = buildNetworkFromConfig(r["network"])
+        linkClasses |= {getLinkClass(net, link) for link in net.links}
+        models |= {gpu.model for gpu in net.accelerators}
+    names = getParamNames(linkClasses, models)
+    params = {name: 1.0 for name in names}
+    steps = {name: INITIAL_STEP for name in names}
+
+    with ProcessPoolExecutor(workers, initializer=initWorker, initargs=(records, defaultProfilePaths or {})) as executor:
+        initialError = error = executor.submit(evaluate, params).result()
+        if verbose:
+            print("initial error %.6f" % error)
+        for rounds in range(MAX_ROUNDS):
+            active = [name for name in names if steps[name] >= MIN_STEP]
+            if len(active) == 0:
+                break
+            candidates = []
+            for name in active:
+                for factor in (steps[name], 1 / steps[name]):
+                    candidate = dict(params)
+                    candidate[name] = min(MAX_SCALE, max(MIN_SCALE, params[name] * factor))
+                    candidates.append((name, candidate))
+            errors = list(executor.map(evaluate, [c for _, c in candidates]))
+
+            # Shrink steps of parameters that improve in neither direction.
+            for i in range(0, len(candidates), 2):
+                if min(errors[i], errors[i + 1]) >= error:
+                    name = candidates[i][0]
+                    steps[name] = math.sqrt(steps[name])
+            best = min(range(len(candidates)), key=lambda i: errors[i])
+            if errors[best] < error:
+                name, params = candidates[best]
+                error = errors[best]
+                if verbose:
+                    print("round %3d  error %.6f  %s = %.4f" % (rounds, error, name, params[name]))
+
+    calibration = toCalibration(params)
+    calibration["error"] = {"initial": initialError, "final": error, "metric": "mean squared log error"}
+    calibration["records"] = len(records)
+    calibration["error"]["resimulated"] = resimulate(records, json.loads(json.dumps(calibration)),
+                                                     defaultProfilePaths or {})
+    if abs(calibration["error"]["resimulated"] - error) > ROUND_TRIP_TOLERANCE:
+        print("Warning! the calibration file gives error %.6f, but the fit gave %.6f."
+              % (calibration["error"]["resimulated"], error))
+    return calibration
+
+# Error of the records simulated from scratch on networks & profiles with the calibration applied,
+# the way users of the calibration file see it.
+def resimulate(records, calibration, defaultProfilePaths):
+    total = 0
+    profileCache = {}
+    for record in records:
+        net = buildNetworkFromConfig(record["network"])
+        profiles = loadRecordProfiles(record, defaultProfilePaths, profileCache)
+        applyCalibration(calibration, net, profiles)
+        predicted = simulator.simulate(loadRecordPlan(record), net, profiles)["iterationTime"]
+        total += math.log(predicted / record["iterationTime"]) ** 2
+    return total / len(records)
+
+def main():
+    parser = argparse.ArgumentParser(description="Fits network & compute parameters to measured iteration times.")
+    parser.add_argument("records", help="measurements (JSON). See the top of calibrate.py.")
+    parser.add_argument("output", help="calibration file to write (JSON).")
+    parser.add_argument("--profile", action="append", default=[], metavar="MODEL=PATH",
+                        help="profile for records without \"profiles\". Can be repeated.")
+    parser.add_argument("--workers", type=int, help="worker processes. Defaults to the number of CPUs.")
+    args = parser.parse_args()
+
+    defaultProfilePaths = {}
+    for entry in args.profile:
+        model, _, path = entry.partition("=")
+        defaultProfilePaths[model] = path
+    with open(args.records) as f:
+        records = json.load(f)
+    calibration = calibrate(records, defaultProfilePaths, args.workers, verbose=True)
+    with open(args.output, "w") as f:
+        json.dump(calibration, f, indent=2)
+    print(json.dumps(calibration, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2020 MIT
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import argparse
+import bisect
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+import simulator
+from networkEditor import Accelerator
+from networkEditor import Simulation
+from networkEditor import buildNetworkFromConfig
+from networkEditor import getLinkClass
+from networkEditor import DEFAULT_BW_PCIE_TO_GPU
+from networkEditor import DEFAULT_LAT_PCIE_TO_GPU
+from planCompiler import compilePlan
+from profile import Profile
+
+# Degradation of links and accelerators during a simulation.
+#   scenario = Scenario("nvlink 3->4 down")
+#   scenario.degradeLink(lid, 1000, 5000, bw=DEFAULT_BW_PCIE_TO_GPU, lat=DEFAULT_LAT_PCIE_TO_GPU)
+#   scenario.slowAccelerator(guid, 0, slowdown=1.5)
+#   simulate(plan, net, profiles, scenario=scenario)
+#
+# Each event sets the state of a link or accelerator from its time onwards, until the next
+# event on the same resource. Values left as None mean the nominal value from the network.
+# The network is never modified; Simulation.run() turns events into per-run schedules and
+# integrates the work of each task over them, so a change in the middle of a task applies
+# to the rest of that task.
+
+# Piecewise-constant value over time. values[i] holds from times[i] until times[i+1].
+class Schedule:
+    def __init__(self, nominal):
+        self.times = [0]
+        self.values = [nominal]
+
+    # Events must be set in time order.
+    def set(self, time, value):
+        assert(time >= self.times[-1])
+        if time == self.times[-1]:
+            self.values[-1] = value
+        else:
+            self.times.append(time)
+            self.values.append(value)
+
+    def valueAt(self, time):
+        return self.values[bisect.bisect_right(self.times, time) - 1]
+
+    # Returns when `work` is done if it starts at `start` and values are the rate of progress.
+    # A zero rate stalls the work; if it never recovers, returns infinity.
+    def finishTime(self, start, work):
+        i = bisect.bisect_right(self.times, start) - 1
+        t = start
+        while True:
+            rate = self.values[i]
+            end = self.times[i + 1] if i + 1 < len(self.times) else math.inf
+            if rate > 0:
+                done = t + work / rate
+                if done <= end:
+                    return done
+                work -= (end - t) * rate
+            elif end == math.inf:
+                return math.inf
+            t = end
+            i += 1
+
+class LinkSchedule:
+    def __init__(self, bw, lat):
+        self.bw = Schedule(bw)
+        self.lat = Schedule(lat)
+
+    # Same as Link.calcXferTime(), but returns (latency at start, finish time).
+    # Bytes are serialized at the scheduled bandwidth, then take the latency at start to propagate.
+    def calcXferTime(self, start, xferBytes):
+        lat = self.lat.valueAt(start)
+        return lat, self.bw.finishTime(start, xferBytes) + lat
+
+class Scenario:
+    def __init__(self, name = "", events = None):
+        self.name = name
+        self.events = events if events is not None else [] # [{"time", "linkId", "bw", "lat"} or {"time", "guid", "slowdown"}]
+
+    def setLink(self, linkId, time, bw = None, lat = None):
+        self.events.append({"time": time, "linkId": linkId, "bw": bw, "lat": lat})
+        return self
+
+    # slowdown is the factor by which compute takes longer; 1 is nominal.
+    def setAccelerator(self, guid, time, slowdown = 1.0):
+        assert(slowdown > 0)
+        self.events.append({"time": time, "guid": guid, "slowdown": slowdown})
+        return self
+
+    # Degrades a link during [startTime, endTime). endTime None means until the end of the run.
+    def degradeLink(self, linkId, startTime, endTime = None, bw = None, lat = None):
+        self.setLink(linkId, startTime, bw, lat)
+        if endTime is not None:
+            self.setLink(linkId, endTime)
+        return self
+
+    def slowAccelerator(self, guid, startTime, endTime = None, slowdown = 2.0):
+        self.setAccelerator(guid, startTime, slowdown)
+        if endTime is not None:
+            self.setAccelerator(guid, endTime)
+        return self
+
+    def linkIds(self):
+        return {e["linkId"] for e in self.events if "linkId" in e}
+
+    def acceleratorGuids(self):
+        return {e["guid"] for e in self.events if "guid" in e}
+
+    # Fills schedules of degraded resources: linkSchedules[linkId] and accelSchedules[guid].
+    # linkBw & linkLat ([linkId]) are the nominal values of the run.
+    def compile(self, net, linkBw, linkLat, linkSchedules, accelSchedules):
+        for e in sorted(self.events, key=lambda e: e["time"]): # Stable, so later events win at equal times.
+            if "linkId" in e:
+                lid = e["linkId"]
+                if linkSchedules[lid] is None:
+                    linkSchedules[lid] = LinkSchedule(linkBw[lid], linkLat[lid])
+                linkSchedules[lid].bw.set(e["time"], linkBw[lid] if e["bw"] is None else e["bw"])
+                linkSchedules[lid].lat.set(e["time"], linkLat[lid] if e["lat"] is None else e["lat"])
+            else:
+                assert(isinstance(net.elements[e["guid"]], Accelerator))
+                if accelSchedules[e["guid"]] is None:
+                    accelSchedules[e["guid"]] = Schedule(1.0)
+                accelSchedules[e["guid"]].set(e["time"], 1.0 / e["slowdown"])
+
+    def toDict(self):
+        return {"name": self.name, "events": self.events}
+
+    @staticmethod
+    def fromDict(d):
+        return Scenario(d.get("name", ""), list(d["events"]))
+
+    def __str__(self):
+        return self.name
+
+# Returns (bw, lat) of the PCIe link from the accelerator, as configured or calibrated in net.
+# Defaults to DEFAULT_*_PCIE_TO_GPU if the accelerator has none.
+def getPcieParams(net, guid):
+    for link in net.linkFromSrc[guid].values():
+        if getLinkClass(net, link) == "pcie":
+            return link.bw, link.lat
+    return DEFAULT_BW_PCIE_TO_GPU, DEFAULT_LAT_PCIE_TO_GPU
+
+# One scenario per resource, each degraded for the whole run:
+#  - every accelerator computes `slowdown` times slower.
+#  - every NVLink falls back to the bandwidth & latency of its source accelerator's PCIe link.
+#  - every other link runs at bwFactor of its bandwidth.
+def singleFaultScenarios(net, slowdown = 2.0, bwFactor = 0.5):
+    scenarios = []
+    for gpu in net.accelerators:
+        scenarios.append(Scenario("accelerator %d %.1fx slower" % (gpu.guid, slowdown)).slowAccelerator(gpu.guid, 0, slowdown=slowdown))
+    for link in net.links:
+        if isinstance(net.elements[link.src], Accelerator) and isinstance(net.elements[link.dst], Accelerator):
+            bw, lat = getPcieParams(net, link.src)
+            scenarios.append(Scenario("link %d->%d falls back to PCIe" % (link.src, link.dst))
+                             .degradeLink(link.lid, 0, bw=bw, lat=lat))
+        else:
+            scenarios.append(Scenario("link %d->%d at %d%% bandwidth" % (link.src, link.dst, bwFactor * 100))
+                             .degradeLink(link.lid, 0, bw=link.bw * bwFactor))
+    return scenarios
+
+# Links & accelerators that tasks of the plan use. Scenarios degrading nothing else can't change its result.
+def findUsedResources(trainingPlan, network, profiles, useGuidForAcceleratorIds = False):
+    sim = Simulation(network)
+    simulator.buildTaskGraph(sim, compilePlan(trainingPlan, network, useGuidForAcceleratorIds), profiles)
+    return {t.linkId for t in sim.linkTasks}, {t.acceleratorGuid for t in sim.compTasks}
+
+##########################################################################
+# Parallel evaluation
+##########################################################################
+workerState = None
+
+def initWorker(plans, network, profiles, useGuidForAcceleratorIds):
+    global workerState
+    simulator.VERBOSE = False
+    Simulation.VERBOSE = False
+    workerState = (plans, network, profiles, useGuidForAcceleratorIds)
+
+def runScenario(job):
+    planIdx, scenario = job
+    plans, network, profiles, useGuidForAcceleratorIds = workerState
+    result = simulator.simulate(plans[planIdx], network, profiles, useGuidForAcceleratorIds, scenario=scenario)
+    return result["iterationTime"]
+
+# Simulates every plan under the nominal network and every scenario (default: singleFaultScenarios()),
+# and returns a summary per plan, most robust (smallest worst-case iteration time) first:
+#   [{"planIdx", "nominal", "worst", "mean", "worstScenario"}, ...]
+# Scenarios that only touch resources a plan doesn't use are not simulated for that plan.
+def rankPlansByRobustness(plans, network, profiles, scenarios = None, useGuidForAcceleratorIds = False, workers = None):
+    if scenarios is None:
+        scenarios = singleFaultScenarios(network)
+    jobs = []
+    for planIdx, plan in enumerate(plans):
+        usedLinks, usedAccelerators = findUsedResources(plan, network, profiles, useGuidForAcceleratorIds)
+        jobs.append((planIdx, None))
+        for scenario in scenarios:
+            if scenario.linkIds() & usedLinks or scenario.acceleratorGuids() & usedAccelerators:
+                jobs.append((planIdx, scenario))
+
+    with ProcessPoolExecutor(workers, initializer=initWorker,
+                             initargs=(plans, network, profiles, useGuidForAcceleratorIds)) as executor:
+        times = list(executor.map(runScenario, jobs, chunksize=max(1, len(jobs) // (4 * (workers or 8)))))
+
+    summaries = [{"planIdx": i, "nominal": None, "worst": None, "mean": None, "worstScenario": None}
+                 for i in range(len(plans))]
+    timesByPlan = [[] for _ in plans]
+    for (planIdx, scenario), t in zip(jobs, times):
+        summary = summaries[planIdx]
+        if scenario is None:
+            summary["nominal"] = t
+            continue
+        timesByPlan[planIdx].append(t)
+        if summary["worst"] is None or t > summary["worst"]:
+            summary["worst"] = t
+            summary["worstScenario"] = scenario.name
+    for planIdx, summary in enumerate(summaries):
+        # Unsimulated scenarios take the nominal time.
+        skipped = len(scenarios) - len(timesByPlan[planIdx])
+        if summary["worst"] is None:
+            summary["worst"] = summary["nominal"]
+        summary["mean"] = (sum(timesByPlan[planIdx]) + skipped * summary["nominal"]) / max(1, len(scenarios))
+    return sorted(summaries, key=lambda s: (s["worst"], s["nominal"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Ranks training plans by their iteration time under single faults.")
+    parser.add_argument("network", help="network config file (JSON). See networkEditor.buildNetworkFromConfig().")
+    parser.add_argument("profile", help="profile of V100 accelerators.")
+    parser.add_argument("plans", nargs="+", help="training plan files.")
+    parser.add_argument("--slowdown", type=float, default=2.0, help="compute slowdown of a faulty accelerator.")
+    parser.add_argument("--bw-factor", type=float, default=0.5, help="bandwidth fraction of a faulty non-NVLink link.")
+    parser.add_argument("--workers", type=int, help="worker processes. Defaults to the number of CPUs.")
+    args = parser.parse_args()
+
+    simulator.VERBOSE = False
+    Simulation.VERBOSE = False
+    with open(args.network) as f:
+        net = buildNetworkFromConfig(json.load(f))
+    profiles = {"V100": Profile(args.profile)}
+    plans = []
+    for path in args.plans:
+        with open(path) as f:
+            plans.append(json.load(f))
+    scenarios = singleFaultScenarios(net, args.slowdown, args.bw_factor)
+    print("# %d scenarios" % len(scenarios))
+    print("#  nominal(ms)  worst(ms)   mean(ms)  plan  worst scenario")
+    for s in rankPlansByRobustness(plans, net, profiles, scenarios, workers=args.workers):
+        print("%13.2f %10.2f %10.2f  %s  %s" % (s["nominal"] / 1000, s["worst"] / 1000, s["mean"] / 1000,
+                                                 args.plans[s["planIdx"]], s["worstScenario"] or "-"))
+
+if __name__ == "__main__":
+    main()
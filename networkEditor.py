@@ -14,35 +14,51 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import hashlib
 import json
 import jsonpickle
 import heapq
+import time
+import math
+import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
 from matplotlib.collections import PathCollection
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 # from grave import plot_network
 # from grave.style import use_attributes
 
-MAX_ELEMENTS = 100
-
 # Default configurations
 DEFAULT_BW_NVLINK = 1600   # in Gbps
 DEFAULT_BW_PCIE_TO_GPU = 1000   # in Gbps
 DEFAULT_LAT_NVLINK = 10   # in microseconds
 DEFAULT_LAT_PCIE_TO_GPU = 17    # in microseconds
 DEFAULT_LAT_NIC_TO_HOST = 100   # in microseconds
+DEFAULT_OPTIMIZER_BW = 200000   # in bytes of parameters updated per microsecond
+
+# Plotting
+LABEL_LIMIT = 64        # Elements are labeled only in networks up to this size.
+GANTT_MAX_ROWS = 64     # Gantt charts show this many busiest resources at most.
+GANTT_WIDTH = 2000      # Busy intervals closer than makespan / GANTT_WIDTH are drawn as one bar.
 
 class Element:
     def __init__(self, net):
+        net.checkWritable()
         self.guid = net.nextGuid
         net.nextGuid += 1
+        net.contentKey = None
         net.elements.append(self)
+        net.linkFromSrc.append(dict())
+        net.pathFromSrc.append(dict())
         
 class Accelerator(Element):
     # model = ""   # GPU model name.
-    def __init__(self, net, model = "V100"):
+    def __init__(self, net, model = "V100", optimizerBw = DEFAULT_OPTIMIZER_BW):
         Element.__init__(self, net)
         self.model = model              # GPU model name.
+        self.optimizerBw = optimizerBw  # Parameter bytes updated per microsecond by the optimizer step.
         self.rank = len(net.accelerators)
         net.accelerators.append(self)
 
@@ -79,12 +95,14 @@ class Link(json.JSONEncoder):
     # bw = 0
     # lat = 0
     def __init__(self, net, src, dst, bandwidth, latency):
+        net.checkWritable()
         self.src = src.guid
         self.dst = dst.guid
         self.bw = bandwidth
         self.lat = latency
         self.lid = net.nextLinkId
         net.nextLinkId += 1
+        net.contentKey = None
         net.links.append(self)
         net.linkFromSrc[src.guid][dst.guid] = self
         net.pathFromSrc[src.guid][dst.guid] = [dst.guid]
@@ -95,6 +113,7 @@ class Link(json.JSONEncoder):
 
 class Network:
     VERBOSE = False
+    stats = None    # SimStats. Set on the class or an instance to record path computation.
 
     def __init__(self):
         # These are populated by constructors. Don't add to them manually.
@@ -105,17 +124,34 @@ class Network:
         self.switches = []
         self.nextLinkId = 0
         self.links = []
-        self.linkFromSrc = [dict() for x in range(MAX_ELEMENTS)] # [<list> src][<dict> dst] == LinkObject
+        self.linkFromSrc = [] # [<list> src][<dict> dst] == LinkObject
         self.arePathsReady = False
     
         # Paths are calculated later.
-        self.pathFromSrc = [dict() for x in range(MAX_ELEMENTS)] # [<list> src][<dict> dst] == <list> [1st_hop, 2nd_hop, ..., final_hop]
+        self.pathFromSrc = [] # [<list> src][<dict> dst] == <list> [1st_hop, 2nd_hop, ..., final_hop]
+        self.routes = None    # sharedTables.RouteTable. If attached, it replaces pathFromSrc.
+        self.contentKey = None # Cached by getContentKey(). Set to None after modifying elements or links in place.
     
     def printConfigInJSON(self):
         states = {"switches": self.switches, "hosts": self.hosts, "accelerators": self.accelerators, "links": self.links}
         return jsonpickle.encode(states, unpicklable=False)
+
+    # Hash of the configuration, computed once until the network changes.
+    def getContentKey(self):
+        if self.contentKey is None:
+            self.contentKey = hashlib.sha256(self.printConfigInJSON().encode()).hexdigest()
+        return self.contentKey
     
     def calcShortestPath(self):
+        self.checkWritable()
+        if self.stats is not None:
+            with self.stats.timePhase("pathComputation"):
+                self.calcShortestPathImpl()
+            self.stats.count("pathUpdates", sum(len(paths) for paths in self.pathFromSrc))
+        else:
+            self.calcShortestPathImpl()
+
+    def calcShortestPathImpl(self):
         if self.VERBOSE:
             print("*** Initial paths ***")
             print(self.pathFromSrc)
@@ -134,7 +170,35 @@ class Network:
                 break
         self.arePathsReady = True
                 
+    # Paths & topology can't change once read-only routes are attached.
+    def checkWritable(self):
+        if self.routes is not None:
+            raise ValueError("Network has read-only routes attached (see attachRoutes()); it can't be modified.")
+
+    # Uses read-only routes in shared memory (see sharedTables.py) instead of calculating paths.
+    # The network must have the same elements & links as the one the routes were exported from.
+    def attachRoutes(self, routes):
+        if routes.elementCount != len(self.elements) or routes.linkCount != len(self.links):
+            raise ValueError("Routes are for %d elements & %d links, but the network has %d elements & %d links." %
+                             (routes.elementCount, routes.linkCount, len(self.elements), len(self.links)))
+        self.routes = routes
+        self.pathFromSrc = None
+        self.arePathsReady = True
+
+    # Returns [linkId, ...] along the path from src to dst.
+    def getPath(self, src, dst):
+        if self.routes is not None:
+            return self.routes.getPath(src, dst)
+        lids = []
+        prevNode = src
+        for nextNode in self.pathFromSrc[src][dst]:
+            lids.append(self.linkFromSrc[prevNode][nextNode].lid)
+            prevNode = nextNode
+        return lids
+
     def printAllPaths(self):
+        if self.routes is not None:
+            raise ValueError("Network has read-only routes attached; paths are in the RouteTable (see getPath()).")
         for src in range(len(self.elements)):
             print("From %3d (%s) ===> to" % (src, type(self.elements[src]).__name__))
             for dst in self.pathFromSrc[src]:
@@ -162,10 +226,43 @@ class Network:
             else:
                 nodeColors.append('yellow')
         if showPlot:
-            nx.draw(g, with_labels=True, node_color=nodeColors, node_shape='s', font_weight='bold')
+            fig, ax = plt.subplots()
+            drawNetwork(ax, self, self.calcHierarchicalLayout())
             plt.show()
         return g
 
+    # Tiers of switches, hosts and accelerators, in linear time. Each host is placed above the middle of
+    # its accelerators and each switch above the middle of its hosts, so children of a parent are adjacent.
+    # Returns [guid] = (x, y).
+    def calcHierarchicalLayout(self):
+        tiers = {Switch: 2, Host: 1, Accelerator: 0}
+        parent = [None] * len(self.elements)
+        children = [[] for _ in self.elements]
+        for e in self.elements:
+            for neighborGuid in self.linkFromSrc[e.guid]:
+                if tiers[type(self.elements[neighborGuid])] > tiers[type(e)]:
+                    parent[e.guid] = neighborGuid
+                    children[neighborGuid].append(e.guid)
+                    break
+
+        pos = [None] * len(self.elements)
+        nextX = [0]
+        # Leaves get consecutive x. Parents are centered above their children.
+        def place(guid):
+            if len(children[guid]) == 0:
+                x = nextX[0]
+                nextX[0] += 1
+            else:
+                for child in children[guid]:
+                    place(child)
+                x = sum(pos[child][0] for child in children[guid]) / len(children[guid])
+            pos[guid] = (x, tiers[type(self.elements[guid])])
+        for tier in (Switch, Host, Accelerator):
+            for e in self.elements:
+                if type(e) == tier and parent[e.guid] is None:
+                    place(e.guid)
+        return pos
+
 
 ##########################################################################
 # Network Simulation
@@ -193,11 +290,12 @@ class ComputeTask(Task):
     # acceleratorGuid = -1
     # layerId = -1
     # computeTime = 0
-    def __init__(self, prevTaskCount, acceleratorGuid, layerId, computeTime):
+    def __init__(self, prevTaskCount, acceleratorGuid, layerId, computeTime, memDelta = 0):
         Task.__init__(self, prevTaskCount)
         self.acceleratorGuid = acceleratorGuid
         self.layerId = layerId
         self.computeTime = computeTime
+        self.memDelta = memDelta    # Bytes of activations stashed (+) or released (-) on the accelerator.
 
 class NetworkTask(Task):
     # linkId = -1
@@ -211,13 +309,22 @@ class NetworkTask(Task):
 class Simulation:
     VERBOSE = True
 
-    def __init__(self, network):
+    def __init__(self, network, stats = None, scenario = None):
         assert(network.arePathsReady)
         self.net = network
+        self.stats = stats  # SimStats, or None to disable instrumentation.
+        self.scenario = scenario  # faultInjection.Scenario of link & accelerator degradations, or None.
+        self.xferCount = 0
         self.linkTasks = [] # Probably not needed in Python ...
         self.compTasks = [] # Probably not needed in Python ...
         self.initialTasks = []
         self.log_tasksByGuid = [list() for x in range(len(network.elements))]
+        self.peakActivationBytes = [0] * len(network.elements) # [guid] = Max. bytes of stashed activations. Set by run().
+        self.linkSchedules = None   # [linkId] = LinkSchedule of the scenario or None. Set by run().
+        # Per-run parameters. None means the values in the network. Change them and reset() to rerun
+        # the same task graph with different parameters.
+        self.linkBw = None          # [linkId] = bandwidth
+        self.linkLat = None         # [linkId] = latency in microseconds
         # self.linkReadyTime = [0] * len(network.links)
         # self.accelReadyTime = [0] * len(network.elements)
     
@@ -240,67 +347,132 @@ class Simulation:
                         % ("%d->%d"%(link.src, link.dst), t.readyTime, t.startTime, t.finishTime, str(t.nextTasks)))
     
     def plotNetwork(self):
-        g = self.net.plotNetwork(showPlot=False)
-        pos = nx.layout.spring_layout(g)
-        
-        nodeColors = []
-        nodeShapes = []
-        accelerators = []
-        hosts = []
-        switches = []
-        for n in g:
-            if isinstance(n, Accelerator):
-                accelerators.append(n)
-            elif isinstance(n, Host):
-                hosts.append(n)
-            elif isinstance(n, Switch):
-                switches.append(n)
-            else:
-                assert(False)
-        
         fig, ax = plt.subplots()
-        node_size = 300
-        anodes = nx.draw_networkx_nodes(g, pos, nodelist=accelerators, node_shape='s', node_color='white', edgecolors='black')
+        linkUtilization, accelUtilization = self.calcUtilization()
+        anodes, edges = drawNetwork(ax, self.net, self.net.calcHierarchicalLayout(), linkUtilization)
+        fig.colorbar(edges, ax=ax, label="link utilization")
         anodes.set_picker(5)
-        hnodes = nx.draw_networkx_nodes(g, pos, nodelist=hosts, node_shape='o', node_color='orange', edgecolors='black')
-        snodes = nx.draw_networkx_nodes(g, pos, nodelist=switches, node_shape='o', node_color=(1,153./255,153./153), edgecolors='black')
-
-        nx.draw_networkx_edges(g, pos, node_size=node_size, arrowstyle='->',
-                                        arrowsize=15, edge_color='black', width=1)
-        nx.draw_networkx_labels(g, pos, font_color='black', font_family='arial',
-                                        font_size=10)
-        
-        # nx.draw_networkx_nodes(g, with_labels=True, node_color=nodeColors, node_shape='s', font_weight='bold')
-        # art.set_picker(10)
-        self.display_accelerators = accelerators
+        self.display_accelerators = self.net.accelerators
         fig.canvas.mpl_connect('pick_event', self.plotOnClick)
         
         plt.show()
-        return g
+        return fig
+
+    # Clears the results of run(), so that the same task graph can run again.
+    def reset(self):
+        for t in self.compTasks + self.linkTasks:
+            t.readyTime = -1
+            t.startTime = None
+            t.finishTime = None
+            t.incompletePrevTaskCount = 0
+        for t in self.compTasks + self.linkTasks:
+            for nextTask in t.nextTasks:
+                nextTask.incompletePrevTaskCount += 1
+        for t in self.initialTasks:
+            t.readyTime = 0
+        self.log_tasksByGuid = [list() for x in range(len(self.net.elements))]
+        self.peakActivationBytes = [0] * len(self.net.elements)
+        self.linkSchedules = None
+
+    # Returns the latest finish time of compute tasks, which completes the run.
+    def getCompletionTime(self):
+        return max([t.finishTime for t in self.compTasks] or [0])
+
+    # Returns ([linkId] = utilization, [guid] = utilization) over the run.
+    # A link is busy while it serializes data; propagation latency doesn't count.
+    def calcUtilization(self):
+        linkBusy, accelBusy = self.calcBusyIntervals()
+        completionTime = self.getCompletionTime()
+        if completionTime <= 0 or math.isinf(completionTime):
+            return [0] * len(self.net.links), [0] * len(self.net.elements)
+        return ([sum(e - s for s, e in intervals) / completionTime for intervals in linkBusy],
+                [sum(e - s for s, e in intervals) / completionTime for intervals in accelBusy])
+
+    # Returns ([linkId] = [(start, end), ...], [guid] = [(start, end), ...]) of busy time, clipped to the completion time.
+    def calcBusyIntervals(self):
+        completionTime = self.getCompletionTime()
+        linkBusy = [[] for _ in self.net.links]
+        accelBusy = [[] for _ in self.net.elements]
+        for t in self.linkTasks:
+            if t.startTime is None:
+                continue
+            schedule = self.linkSchedules[t.linkId] if self.linkSchedules else None
+            if schedule is not None:
+                lat = schedule.lat.valueAt(t.startTime)
+            else:
+                lat = self.linkLat[t.linkId] if self.linkLat is not None else self.net.links[t.linkId].lat
+            linkBusy[t.linkId].append((t.startTime, min(t.finishTime - lat, completionTime)))
+        for t in self.compTasks:
+            if t.startTime is None or t.finishTime == t.startTime:
+                continue
+            accelBusy[t.acceleratorGuid].append((t.startTime, min(t.finishTime, completionTime)))
+        return linkBusy, accelBusy
+
+    # Saves the topology, with links colored by utilization, to an image file.
+    def saveNetworkPlot(self, path):
+        fig = Figure(figsize=(12, 6))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        linkUtilization, accelUtilization = self.calcUtilization()
+        anodes, edges = drawNetwork(ax, self.net, self.net.calcHierarchicalLayout(), linkUtilization)
+        fig.colorbar(edges, ax=ax, label="link utilization")
+        fig.savefig(path, bbox_inches="tight")
+
+    # Saves a Gantt chart of the busiest accelerators & links to an image file.
+    # Bars closer than one pixel apart are merged, so the cost doesn't grow with the number of tasks drawn.
+    def saveGantt(self, path, maxRows = GANTT_MAX_ROWS, width = GANTT_WIDTH):
+        linkBusy, accelBusy = self.calcBusyIntervals()
+        rows = [("%s" % self.net.elements[guid], "tab:blue", intervals)
+                for guid, intervals in enumerate(accelBusy) if len(intervals) > 0]
+        rows += [("%d->%d" % (self.net.links[lid].src, self.net.links[lid].dst), "tab:orange", intervals)
+                 for lid, intervals in enumerate(linkBusy) if len(intervals) > 0]
+        if len(rows) > maxRows:
+            busiest = sorted(range(len(rows)), key=lambda i: -sum(e - s for s, e in rows[i][2]))[:maxRows]
+            rows = [rows[i] for i in sorted(busiest)]
+        resolution = self.getCompletionTime() / width
+
+        fig = Figure(figsize=(12, 1.5 + 0.25 * len(rows)))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        for i, (label, color, intervals) in enumerate(rows):
+            bars = []
+            intervals.sort()
+            barStart, barEnd = intervals[0]
+            for s, e in intervals[1:]:
+                if s <= barEnd + resolution:
+                    barEnd = max(barEnd, e)
+                else:
+                    bars.append((barStart, barEnd - barStart))
+                    barStart, barEnd = s, e
+            bars.append((barStart, barEnd - barStart))
+            ax.broken_barh(bars, (i - 0.4, 0.8), facecolors=color)
+        ax.set_yticks(range(len(rows)))
+        ax.set_yticklabels([label for label, _, _ in rows])
+        ax.invert_yaxis()
+        ax.set_xlabel("time (us)")
+        fig.savefig(path, bbox_inches="tight")
 
     # Returns the final link transfer task.
     def scheduleXfer(self, src, dst, xferBytes, prevComputeTask = None):
         if src == dst:
             return prevComputeTask
 
-        path = self.net.pathFromSrc[src][dst]
-        prevNode = src
+        self.xferCount += 1
         prevTask = prevComputeTask
-        for nextNode in path:
-            link = self.net.linkFromSrc[prevNode][nextNode]
-            task = NetworkTask(0 if prevTask == None else 1, link.lid, xferBytes)
+        for lid in self.net.getPath(src, dst):
+            task = NetworkTask(0 if prevTask == None else 1, lid, xferBytes)
             if prevTask == None:
                 self.initialTasks.append(task)
                 task.readyTime = 0
+            else:
+                prevTask.registerNextTask(task)
             self.linkTasks.append(task)
-            prevTask.registerNextTask(task)
-            prevNode = nextNode
             prevTask = task
         return prevTask
 
     # Returns compute task.
-    def scheduleCompute(self, acceleratorId, layerId, computeTime, prevXferTasks = []):
-        task = ComputeTask(len(prevXferTasks), acceleratorId, layerId, computeTime)
+    def scheduleCompute(self, acceleratorId, layerId, computeTime, prevXferTasks = [], memDelta = 0):
+        task = ComputeTask(len(prevXferTasks), acceleratorId, layerId, computeTime, memDelta)
         if len(prevXferTasks) == 0:
             self.initialTasks.append(task)
             task.readyTime = 0
@@ -310,15 +482,39 @@ class Simulation:
         return task
 
     def run(self):
+        stats = self.stats
+        if stats is not None:
+            runStartTime = time.perf_counter()
+            loggingTime = 0
+        trackHeap = stats is not None
+        peakHeapSize = 0
+        pushes = len(self.initialTasks)
+
         taskq = [(t.readyTime, t) for t in self.initialTasks]
         linkReadyTime = [0] * len(self.net.links)  # [linkId] = Microseconds when link becomes free.
         accelReadyTime = [0] * len(self.net.elements) # [guid] = Microseconds when accelerator becomes free.
+        activationBytes = [0] * len(self.net.elements) # [guid] = Bytes of activations currently stashed.
+        peakActivationBytes = self.peakActivationBytes
+        linkBw = self.linkBw if self.linkBw is not None else [link.bw for link in self.net.links]
+        linkLat = self.linkLat if self.linkLat is not None else [link.lat for link in self.net.links]
+        # Per-run schedules of degraded resources. The network itself is never modified.
+        linkSchedules = [None] * len(self.net.links)      # [linkId] = LinkSchedule or None if nominal.
+        accelSchedules = [None] * len(self.net.elements)  # [guid] = Schedule of compute speed or None if nominal.
+        if self.scenario is not None:
+            self.scenario.compile(self.net, linkBw, linkLat, linkSchedules, accelSchedules)
+            self.linkSchedules = linkSchedules
         
         heapq.heapify(taskq)
         if self.VERBOSE:
+            if stats is not None:
+                logStartTime = time.perf_counter()
             print("Initial task: " + jsonpickle.encode(taskq, unpicklable=False))
+            if stats is not None:
+                loggingTime += time.perf_counter() - logStartTime
 
         while len(taskq) > 0:
+            if trackHeap and len(taskq) > peakHeapSize:
+                peakHeapSize = len(taskq)
             readyTime, task = heapq.heappop(taskq)
             assert(task.startTime == None)
             assert(task.finishTime == None)
@@ -330,8 +526,16 @@ class Simulation:
                 self.log_tasksByGuid[task.acceleratorGuid].append(task)
                 
                 task.startTime = max(readyTime, accelReadyTime[task.acceleratorGuid])
-                task.finishTime = task.startTime + task.computeTime
+                if accelSchedules[task.acceleratorGuid] is None:
+                    task.finishTime = task.startTime + task.computeTime
+                else:
+                    task.finishTime = accelSchedules[task.acceleratorGuid].finishTime(task.startTime, task.computeTime)
                 accelReadyTime[task.acceleratorGuid] = task.finishTime
+                if task.memDelta != 0:
+                    # Tasks on an accelerator are started in this order, so this tracks its memory over time.
+                    activationBytes[task.acceleratorGuid] += task.memDelta
+                    if activationBytes[task.acceleratorGuid] > peakActivationBytes[task.acceleratorGuid]:
+                        peakActivationBytes[task.acceleratorGuid] = activationBytes[task.acceleratorGuid]
                 
                 for nextTask in task.nextTasks:
                     nextTask.readyTime = max(nextTask.readyTime, task.finishTime)
@@ -340,6 +544,7 @@ class Simulation:
                     
                     if nextTask.incompletePrevTaskCount == 0:
                         heapq.heappush(taskq, (nextTask.readyTime, nextTask))
+                        pushes += 1
                         
             elif isinstance(task, NetworkTask):
                 link = self.net.links[task.linkId]
@@ -351,12 +556,16 @@ class Simulation:
                 
                 task.startTime = max(readyTime, linkReadyTime[task.linkId])
                 assert(task.xferBytes > 0)
-                task.finishTime = task.startTime + link.calcXferTime(task.xferBytes)
-                linkReadyTime[task.linkId] = task.finishTime - link.lat # A link can take new ingress data before done with egress work.
+                if linkSchedules[task.linkId] is None:
+                    lat = linkLat[task.linkId]
+                    task.finishTime = task.startTime + lat + task.xferBytes / linkBw[task.linkId] # Link.calcXferTime()
+                else:
+                    lat, task.finishTime = linkSchedules[task.linkId].calcXferTime(task.startTime, task.xferBytes)
+                linkReadyTime[task.linkId] = task.finishTime - lat # A link can take new ingress data before done with egress work.
                 
                 for nextTask in task.nextTasks:
                     if isinstance(nextTask, NetworkTask):
-                        nextTask.readyTime = max(nextTask.readyTime, task.startTime + link.lat)
+                        nextTask.readyTime = max(nextTask.readyTime, task.startTime + lat)
                     elif isinstance(nextTask, ComputeTask):
                         nextTask.readyTime = max(nextTask.readyTime, task.finishTime)
                     else:
@@ -366,11 +575,27 @@ class Simulation:
                     assert(nextTask.incompletePrevTaskCount >= 0)
                     if nextTask.incompletePrevTaskCount == 0:
                         heapq.heappush(taskq, (nextTask.readyTime, nextTask))
+                        pushes += 1
             # self.dumpInternalState()
         if self.VERBOSE:
+            if stats is not None:
+                logStartTime = time.perf_counter()
             print("simulation completed.")
             self.dumpInternalState()
             print("")
+            if stats is not None:
+                loggingTime += time.perf_counter() - logStartTime
+
+        if stats is not None:
+            # Every pushed task is popped exactly once.
+            stats.count("heapPushes", pushes)
+            stats.count("heapPops", pushes)
+            stats.count("computeTasks", len(self.compTasks))
+            stats.count("networkTasks", len(self.linkTasks))
+            stats.count("transfersScheduled", self.xferCount)
+            stats.updatePeakHeapSize(peakHeapSize)
+            stats.addTime("logging", loggingTime)
+            stats.addTime("simulationRun", time.perf_counter() - runStartTime - loggingTime)
 
     def dumpInternalState(self):
         # print("Dumping internal states...")
@@ -403,6 +628,86 @@ def addAccelerators(net, switchOrHost, numberOfGpus,
                 Link(net, gpu1, gpu2, nvlinkBwAmongGpus, DEFAULT_LAT_NVLINK)
         
 
+# Links are calibrated per class: "nvlink" between accelerators, "pcie" between an accelerator and
+# a host or switch, and "nic" among hosts & switches.
+LINK_CLASSES = ("nvlink", "pcie", "nic")
+
+def getLinkClass(net, link):
+    srcIsAccelerator = isinstance(net.elements[link.src], Accelerator)
+    dstIsAccelerator = isinstance(net.elements[link.dst], Accelerator)
+    if srcIsAccelerator and dstIsAccelerator:
+        return "nvlink"
+    if srcIsAccelerator or dstIsAccelerator:
+        return "pcie"
+    return "nic"
+
+# Calibration file written by calibrate.py:
+#   {"links": {"nvlink": {"bwScale": 0.8, "latScale": 1.2}, ...}, "computeScale": {"V100": 1.1}, ...}
+def loadCalibration(path):
+    with open(path) as f:
+        return json.load(f)
+
+# Scales bandwidth & latency of links in net by their class, and compute times of profiles ([model] = Profile).
+# Apply a calibration to a network only once. Models sharing one Profile must have the same compute scale.
+def applyCalibration(calibration, net, profiles = None):
+    computeScales = {}
+    if profiles is not None:
+        computeScales = {model: scale for model, scale in calibration.get("computeScale", {}).items() if model in profiles}
+        for model, scale in computeScales.items():
+            for other, otherScale in computeScales.items():
+                if profiles[other] is profiles[model] and otherScale != scale:
+                    raise ValueError("Models %s and %s share one Profile but are calibrated differently." % (model, other))
+    for link in net.links:
+        scales = calibration.get("links", {}).get(getLinkClass(net, link))
+        if scales is not None:
+            link.bw *= scales.get("bwScale", 1.0)
+            link.lat *= scales.get("latScale", 1.0)
+    net.contentKey = None
+    for model, scale in computeScales.items():
+        profiles[model].computeScale = scale
+
+# Draws the network on ax at pos ([guid] = (x, y)). Links of both directions are drawn as one line,
+# colored by the busier direction if linkUtilization ([linkId] = 0~1) is given.
+# Links within a tier are bent downward so that they don't overlap each other.
+# Returns (PathCollection of accelerators in the order of net.accelerators, LineCollection of links).
+def drawNetwork(ax, net, pos, linkUtilization = None):
+    utilizationByPair = {}
+    for link in net.links:
+        pair = (min(link.src, link.dst), max(link.src, link.dst))
+        u = linkUtilization[link.lid] if linkUtilization else 0
+        utilizationByPair[pair] = max(utilizationByPair.get(pair, 0), u)
+    lines = []
+    for a, b in utilizationByPair:
+        (x1, y1), (x2, y2) = pos[a], pos[b]
+        if y1 == y2:
+            dip = min(0.4, 0.1 + 0.02 * abs(x2 - x1))
+            lines.append([(x1, y1), ((x1 + x2) / 2, y1 - dip), (x2, y2)])
+        else:
+            lines.append([(x1, y1), (x2, y2)])
+    utilization = np.array(list(utilizationByPair.values()))
+    edges = LineCollection(lines, cmap="plasma", linewidths=0.5 + 2.5 * utilization, zorder=1)
+    if linkUtilization:
+        edges.set_array(utilization)
+        edges.set_clim(0, 1)
+    else:
+        edges.set_color("gray")
+    ax.add_collection(edges)
+
+    labeled = len(net.elements) <= LABEL_LIMIT
+    markerSize = 200 if labeled else max(2, 36 * LABEL_LIMIT / len(net.elements))
+    def scatter(elements, marker, color):
+        xy = np.array([pos[e.guid] for e in elements]).reshape(-1, 2)
+        return ax.scatter(xy[:, 0], xy[:, 1], s=markerSize, marker=marker, color=color, edgecolors="black", zorder=2)
+    anodes = scatter(net.accelerators, "s", "white")
+    scatter(net.hosts, "o", "orange")
+    scatter(net.switches, "o", (1, 153./255, 153./255))
+    if labeled:
+        for e in net.elements:
+            ax.annotate(str(e.guid), pos[e.guid], ha="center", va="center", fontsize=8, zorder=3)
+    ax.autoscale()
+    ax.set_axis_off()
+    return anodes, edges
+
 def sanityCheck(net):
     print(net.printConfigInJSON())
     net.calcShortestPath()
@@ -443,6 +748,46 @@ def buildAwsP3Network(hostCount, gpusPerHost, hostToTorBw, hostToTorLat):
     net.calcShortestPath()
     return net
 
+NETWORK_BUILDERS = {"buildSimpleNetwork": buildSimpleNetwork,
+                    "buildHostAndGpuNetwork": buildHostAndGpuNetwork,
+                    "buildAwsP3Network": buildAwsP3Network}
+
+# Builds a network from its JSON description. Two forms are accepted:
+#  - {"builder": "buildAwsP3Network", "args": [2, 4, 10, 10]} calls one of NETWORK_BUILDERS.
+#  - The output of Network.printConfigInJSON(), e.g. simpleNet.json.
+# Paths are calculated before returning, unless calcPaths is False for the printConfigInJSON() form
+# (e.g. to attach shared routes instead). Builders always calculate paths.
+def buildNetworkFromConfig(config, calcPaths = True):
+    if "builder" in config:
+        if config["builder"] not in NETWORK_BUILDERS:
+            raise ValueError("Unknown network builder %s." % config["builder"])
+        net = NETWORK_BUILDERS[config["builder"]](*config.get("args", []))
+        if not net.arePathsReady:
+            net.calcShortestPath()
+        return net
+
+    net = Network()
+    elements = [(sw["guid"], "switch", sw) for sw in config.get("switches", [])]
+    elements += [(host["guid"], "host", host) for host in config.get("hosts", [])]
+    elements += [(gpu["guid"], "accelerator", gpu) for gpu in config.get("accelerators", [])]
+    elements.sort(key=lambda x: x[0])
+    for guid, kind, desc in elements:
+        if guid != net.nextGuid:
+            raise ValueError("Network config has no element with guid %d." % net.nextGuid)
+        if kind == "switch":
+            Switch(net, desc.get("bw", -1), desc.get("lat", 0))
+        elif kind == "host":
+            Host(net, desc.get("sharedMaxPcieBw", 1000))
+        else:
+            Accelerator(net, desc.get("model", "V100"), desc.get("optimizerBw", DEFAULT_OPTIMIZER_BW))
+    for desc in config.get("links", []):
+        if desc["src"] >= len(net.elements) or desc["dst"] >= len(net.elements):
+            raise ValueError("Link %d->%d refers to an unknown element." % (desc["src"], desc["dst"]))
+        Link(net, net.elements[desc["src"]], net.elements[desc["dst"]], desc["bw"], desc["lat"])
+    if calcPaths:
+        net.calcShortestPath()
+    return net
+
 ##########################################################################
 # Tests
 ##########################################################################
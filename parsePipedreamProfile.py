@@ -4,12 +4,56 @@ import sys
 import json
 import jsonpickle
 import re
-import glob
+from multiprocessing import Pool
 from os import listdir
 from os.path import isfile, join
 from profile import Profile
 from trainingPlanEditor import Layer
 
+BATCH_FILE_PATTERN = re.compile(r'(\d+)\.txt')
+LAYER_PATTERN = re.compile(r'node(\d+) -- (.*) -- forward_compute_time=(\d*\.\d+|\d+), backward_compute_time=(\d*\.\d+|\d+), activation_size=(\d*\.\d+|\d+), parameter_size=(\d*\.\d+|\d+)')
+EDGE_PATTERN = re.compile(r'\s+node(\d+) -- node(\d+)')
+
+# Parses a single "<batchSize>.txt" file. Runs in a worker process.
+# Returns (batchSize, [(layerId, name, forwardComp, backwardComp, activationSize, parameterSize), ...], [(prevLayerId, currLayerId), ...])
+def parseBatchFile(args):
+    filepath, batchSize = args
+    layers = []
+    edges = []
+    with open(filepath) as f:
+        for line in f:
+            layerMatch = LAYER_PATTERN.match(line)
+            if layerMatch:
+                layers.append((int(layerMatch.group(1)), layerMatch.group(2),
+                               float(layerMatch.group(3)), float(layerMatch.group(4)),
+                               float(layerMatch.group(5)), float(layerMatch.group(6))))
+                continue
+            edgeMatch = EDGE_PATTERN.match(line)
+            if edgeMatch:
+                edges.append((int(edgeMatch.group(1)), int(edgeMatch.group(2))))
+    return batchSize, layers, edges
+
+# Orders layers so that every layer comes after all of its prevLayers, as simulate() expects.
+# Ties are broken by layerId, which keeps PipeDream's own ordering when it is already valid.
+def sortInDagOrder(layerIds, prevLayerIds):
+    remaining = {lid: len(prevLayerIds[lid]) for lid in layerIds}
+    nextLayerIds = {lid: [] for lid in layerIds}
+    for lid in layerIds:
+        for prevId in prevLayerIds[lid]:
+            nextLayerIds[prevId].append(lid)
+    ready = sorted(lid for lid in layerIds if remaining[lid] == 0)
+    order = []
+    while len(ready) > 0:
+        lid = ready.pop(0)
+        order.append(lid)
+        for nextId in nextLayerIds[lid]:
+            remaining[nextId] -= 1
+            if remaining[nextId] == 0:
+                ready.append(nextId)
+                ready.sort()
+    assert(len(order) == len(layerIds)) # Otherwise, the graph has a cycle.
+    return order
+
 # Converts Pipedream's profile to dtSim's profile.
 def main():
     if len(sys.argv) != 2:
@@ -22,77 +66,63 @@ def main():
     if folderpath[-1] != '/':
         folderpath += '/'
 
+    jobs = []
+    for filename in listdir(folderpath):
+        batchSizeMatch = BATCH_FILE_PATTERN.fullmatch(filename)
+        if batchSizeMatch and isfile(join(folderpath, filename)):
+            jobs.append((folderpath + filename, int(batchSizeMatch.group(1))))
+    jobs.sort(key=lambda job: job[1])
+    for filepath, batchSize in jobs:
+        print("filepath:%s, batchSize:%d"%(filepath, batchSize))
+    if len(jobs) == 0:
+        print("No <batchSize>.txt files in %s" % folderpath)
+        print("Usage:")
+        print("python3 parseProfile.py \"path/to/folder/containing/txt/files/\"")
+        return
+
+    with Pool(min(len(jobs), 8)) as pool:
+        results = pool.map(parseBatchFile, jobs)
+
+    # Layer structure & activation sizes are taken from the smallest batch size.
+    _, baseLayers, baseEdges = results[0]
+    layerIds = [layer[0] for layer in baseLayers]
+    layerIndex = {layer[0]: i for i, layer in enumerate(baseLayers)}
+    batchSizes = [batchSize for batchSize, _, _ in results]
+
+    # Preallocated: times[layerIdx][phase][fileIdx]
+    times = [[[0.0] * len(results), [0.0] * len(results)] for _ in baseLayers]
+    for fileIdx, (_, layers, _) in enumerate(results):
+        assert(len(layers) == len(baseLayers))
+        for layerId, _, forwardComp, backwardComp, _, _ in layers:
+            layerTimes = times[layerIndex[layerId]]
+            layerTimes[0][fileIdx] = forwardComp
+            layerTimes[1][fileIdx] = backwardComp
+
     profile = Profile()
-    
-    # print(glob.glob(path + "*.txt"))
-    onlyfiles = [f for f in listdir(folderpath) if isfile(join(folderpath, f))]
-    
-    isFirstFile = True
+    for layerIdx, layerId in enumerate(layerIds):
+        profile.setDatapoints(layerId, batchSizes, times[layerIdx])
+
+    # The input of a layer is the activation (output) of its previous layer.
+    baseBatchSize = batchSizes[0]
+    prevLayers = {layerId: [] for layerId in layerIds}
+    for prevLayerId, currLayerId in baseEdges:
+        activationSize = baseLayers[layerIndex[prevLayerId]][4]
+        if activationSize == 0: # e.g. the input layer. Pipedream doesn't supply its size.
+            print("Warning! layer %d reports no activation, so its edge to layer %d is written with InputBytesPerSample 0. "
+                  "The simulator treats it as a dependency that moves no data; correct it manually to simulate the transfer."
+                  % (prevLayerId, currLayerId))
+        prevLayers[currLayerId].append({"LayerId": prevLayerId, "InputBytesPerSample": activationSize / baseBatchSize})
+
     trainingPlan = []
-    layerInfo = {} # [layerId] = (layerId, name, parameterSize, activationSize)
-    for filename in onlyfiles:
-        batchSizeMatch = re.match('(\d+).txt', filename)
-        if not batchSizeMatch:
-            continue
-        batchSize = int(batchSizeMatch.group(1))
-        print("filepath:%s, batchSize:%d"%(folderpath+filename, batchSize))
-        f = open(folderpath + filename)
-        
-        for line in f:
-            components = line.split(' -- ')
-            layerIdMatch = re.match('node(\d+)', components[0])
-            if layerIdMatch:
-                layerId = int(layerIdMatch.group(1))
-                name = components[1]
-                matchTimes = re.match('forward_compute_time=(\d*\.\d+|\d+), backward_compute_time=(\d*\.\d+|\d+), activation_size=(\d*\.\d+|\d+), parameter_size=(\d*\.\d+|\d+)', components[2])
-                fowardComp = float(matchTimes.group(1))
-                backwardComp = float(matchTimes.group(2))
-                activationSize = float(matchTimes.group(3))
-                parameterSize = float(matchTimes.group(4))
-                # print("%d %s %f %f %f %f" % (layerId, name, fowardComp, backwardComp, activationSizeComp, parameterSize))
-                # def addDatapoint(self, layerId, localBatch, computeTime, alreadySorted = False):
-                # batchSize = 64
-                profile.addDatapoint(layerId, batchSize, [fowardComp, backwardComp])
+    for layerId in sortInDagOrder(layerIds, {lid: [p["LayerId"] for p in prevLayers[lid]] for lid in layerIds}):
+        _, name, _, _, _, parameterSize = baseLayers[layerIndex[layerId]]
+        trainingPlan.append(Layer(layerId, name, parameterSize, prevLayers[layerId]))
 
-                # populate for training plan.
-                # plan.append(Layer(2, 10000, [{"LayerId": 1, "InputBytesPerSample": 100}],
-                #                  [{"id": 3, "localBatch": 32}, {"id": 5, "localBatch": 32}]))
-                if isFirstFile:
-                    layerInfo[layerId] = (layerId, name, parameterSize, activationSize)
-            elif isFirstFile:
-                prevLayerIdMatch = re.match('\s+node(\d+)', components[0])
-                currLayerIdMatch = re.match('node(\d+)\s*', components[1])
-                if not prevLayerIdMatch:
-                    break
-                prevLayerId = int(prevLayerIdMatch.group(1))
-                currLayerId = int(currLayerIdMatch.group(1))
-                # WARNING. only support sequencial layers.
-                
-                if len(trainingPlan) == 0: # If prevLayer is input layer, it is added specially.
-                    layerId, name, parameterSize, activationSize = layerInfo[prevLayerId]
-                    assert(layerId == prevLayerId)
-                    trainingPlan.append(Layer(layerId, name, parameterSize, []))
-                    
-                layerId, name, parameterSize, activationSize = layerInfo[currLayerId]
-                assert(layerId == currLayerId)
-                if len(trainingPlan) >= layerId:
-                    print("Warning! non-sequencial connection. Correct inputBytes manually for layer %d. (Pipedream doesn't supply enough info.)" % layerId)
-                    trainingPlan[layerId-1].prevLayers.append(
-                        {"LayerId": prevLayerId, "InputBytesPerSample": 0}
-                    )
-                else:
-                    trainingPlan.append(Layer(layerId, name, parameterSize, 
-                            [{"LayerId": prevLayerId, "InputBytesPerSample": (activationSize / batchSize)}]))
-                
-        isFirstFile = False
-        
-    # print(json.dumps(profile.datapoint))
     with open(folderpath + "profile.json", 'w') as outfile:
         json.dump(profile.datapoint, outfile)
     with open(folderpath + "plan_unassigned.json", "w") as outfile:
-        # outfile.write(jsonpickle.encode(trainingPlan, unpicklable=False))
         planInJson = jsonpickle.encode(trainingPlan, unpicklable=False)
         json.dump(json.loads(planInJson), outfile, indent=2, sort_keys=False)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
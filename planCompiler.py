@@ -0,0 +1,193 @@
+# Copyright (c) 2020 MIT
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+import weakref
+from collections import OrderedDict
+from networkEditor import Accelerator
+
+# Validated, integer-indexed form of a training plan (the JSON list of layers).
+# Layers are indexed by their position in DAG order (layerIdx), and replicas by their
+# position in "assignedAccelerators" (replicaIdx). The caller's plan is never modified.
+class CompiledPlan:
+    def __init__(self, trainingPlan, network, useGuidForAcceleratorIds=False):
+        self.planInJson = json.dumps(trainingPlan, sort_keys=True) # Canonical form of the source plan.
+        if len(trainingPlan) == 0:
+            raise ValueError("Plan has no layers.")
+        layersById = {}
+        for layer in trainingPlan:
+            if layer["layerId"] in layersById:
+                raise ValueError("Duplicate layerId %d." % layer["layerId"])
+            layersById[layer["layerId"]] = layer
+        order = self.sortInDagOrder(trainingPlan, layersById)
+
+        self.layerIds = [layer["layerId"] for layer in order]          # [layerIdx] = layerId
+        self.indexById = {lid: idx for idx, lid in enumerate(self.layerIds)}
+        self.names = [layer.get("name", "") for layer in order]
+        self.modelBytes = [layer.get("modelBytes", 0) for layer in order]
+        self.tensorParallel = [layer.get("tensorParallel", 1) for layer in order] # [layerIdx] = tensor-parallel degree
+        self.recompute = [bool(layer.get("recompute", False)) for layer in order]  # [layerIdx] = activation checkpointing
+        self.guids = []           # [layerIdx][replicaIdx] = accelerator guid
+        self.shardGuids = []      # [layerIdx][replicaIdx] = [guid, ...] of tensor-parallel shards. shard 0 is in guids.
+        self.models = []          # [layerIdx][replicaIdx] = accelerator model name
+        self.localBatches = []    # [layerIdx][replicaIdx] = local batch size
+        self.batchOffsets = []    # [layerIdx][replicaIdx] = first sample of the replica. (prefix sum, has an extra last entry)
+        for idx, layer in enumerate(order):
+            assignments = layer.get("assignedAccelerators")
+            if not assignments:
+                raise ValueError("Layer %d has no assignedAccelerators." % layer["layerId"])
+            if self.tensorParallel[idx] < 1:
+                raise ValueError("Layer %d has tensorParallel %d." % (layer["layerId"], self.tensorParallel[idx]))
+            guids = [self.resolveGuid(network, a['id'], useGuidForAcceleratorIds, layer["layerId"]) for a in assignments]
+            self.shardGuids.append([self.resolveShards(network, aid, self.tensorParallel[idx], layer["layerId"]) for aid in guids])
+            localBatches = [a['localBatch'] for a in assignments]
+            if min(localBatches) <= 0:
+                raise ValueError("Layer %d has a replica with non-positive localBatch." % layer["layerId"])
+            offsets = [0]
+            for localBatch in localBatches:
+                offsets.append(offsets[-1] + localBatch)
+            self.guids.append(guids)
+            self.models.append([network.elements[aid].model for aid in guids])
+            self.localBatches.append(localBatches)
+            self.batchOffsets.append(offsets)
+
+        self.totalBatch = self.batchOffsets[0][-1]
+        for idx, offsets in enumerate(self.batchOffsets):
+            if offsets[-1] != self.totalBatch:
+                raise ValueError("Layer %d processes %d samples, but layer %d processes %d." %
+                                 (self.layerIds[idx], offsets[-1], self.layerIds[0], self.totalBatch))
+
+        # Adjacency. [layerIdx] = [(layerIdx, bytesPerSample), ...]
+        # An edge of 0 bytes per sample is a dependency only; it moves no data between accelerators.
+        self.prevLayers = [[] for _ in order]
+        self.nextLayers = [[] for _ in order]
+        for idx, layer in enumerate(order):
+            for prevLayerPtr in layer["prevLayers"]:
+                if prevLayerPtr["InputBytesPerSample"] < 0:
+                    raise ValueError("Layer %d has negative InputBytesPerSample from layer %d." %
+                                     (layer["layerId"], prevLayerPtr["LayerId"]))
+                prevIdx = self.indexById[prevLayerPtr["LayerId"]]
+                self.prevLayers[idx].append((prevIdx, prevLayerPtr["InputBytesPerSample"]))
+                self.nextLayers[prevIdx].append((idx, prevLayerPtr["InputBytesPerSample"]))
+
+        # Bytes to all-reduce among tensor-parallel shards: activations in forward, input gradients in backward.
+        self.outputBytesPerSample = [max([b for _, b in self.nextLayers[idx]] or [0]) for idx in range(len(order))]
+        self.inputBytesPerSample = [sum([b for _, b in self.prevLayers[idx]]) for idx in range(len(order))]
+
+        # There should be only one layer that doesn't have any nextLayer and it should be the last layer.
+        sinks = [self.layerIds[idx] for idx in range(len(order)) if len(self.nextLayers[idx]) == 0]
+        if len(sinks) != 1:
+            raise ValueError("Plan must have exactly one final layer, but found %s." % str(sinks))
+        self.lastLayerIdx = len(order) - 1
+        self.firstLayerIdxs = [idx for idx in range(len(order)) if len(self.prevLayers[idx]) == 0]
+
+        # Data movement between replicas, from overlapping sample ranges.
+        # [layerIdx][replicaIdx] = [(srcLayerIdx, srcReplicaIdx, xferBytes), ...]. xferBytes 0 is a dependency only.
+        self.fwdInputs = [[[] for _ in self.guids[idx]] for idx in range(len(order))]
+        self.bwdInputs = [[[] for _ in self.guids[idx]] for idx in range(len(order))]
+        for idx in range(len(order)):
+            for prevIdx, bytesPerSample in self.prevLayers[idx]:
+                for srcReplica, dstReplica, samples in self.getOverlaps(prevIdx, idx):
+                    self.fwdInputs[idx][dstReplica].append((prevIdx, srcReplica, samples * bytesPerSample))
+                for srcReplica, dstReplica, samples in self.getOverlaps(idx, prevIdx):
+                    self.bwdInputs[prevIdx][dstReplica].append((idx, srcReplica, samples * bytesPerSample))
+
+    def __len__(self):
+        return len(self.layerIds)
+
+    @staticmethod
+    def resolveGuid(network, aid, useGuidForAcceleratorIds, layerId):
+        if useGuidForAcceleratorIds:
+            if aid < 0 or aid >= len(network.elements) or not isinstance(network.elements[aid], Accelerator):
+                raise ValueError("Layer %d is assigned to guid %d, which is not an accelerator." % (layerId, aid))
+            return aid
+        if aid < 1 or aid > len(network.accelerators):
+            raise ValueError("Layer %d is assigned to accelerator %d, but the network has %d accelerators." %
+                             (layerId, aid, len(network.accelerators)))
+        return network.accelerators[aid-1].guid
+
+    # Tensor-parallel shards of a replica live on consecutive ranks, as in Megatron.
+    @staticmethod
+    def resolveShards(network, guid, tensorParallel, layerId):
+        rank = network.elements[guid].rank
+        if rank + tensorParallel > len(network.accelerators):
+            raise ValueError("Layer %d needs %d tensor-parallel shards from accelerator %d, but the network has %d accelerators." %
+                             (layerId, tensorParallel, rank + 1, len(network.accelerators)))
+        return [network.accelerators[rank + k].guid for k in range(tensorParallel)]
+
+    # Keeps the given order when it's already a valid DAG order.
+    @staticmethod
+    def sortInDagOrder(trainingPlan, layersById):
+        position = {layer["layerId"]: i for i, layer in enumerate(trainingPlan)}
+        remaining = {}
+        nextLayerIds = {lid: [] for lid in layersById}
+        for layer in trainingPlan:
+            remaining[layer["layerId"]] = len(layer["prevLayers"])
+            for prevLayerPtr in layer["prevLayers"]:
+                if prevLayerPtr["LayerId"] not in layersById:
+                    raise ValueError("Layer %d refers to unknown prevLayer %d." % (layer["layerId"], prevLayerPtr["LayerId"]))
+                nextLayerIds[prevLayerPtr["LayerId"]].append(layer["layerId"])
+        ready = [layer["layerId"] for layer in trainingPlan if remaining[layer["layerId"]] == 0]
+        order = []
+        while len(ready) > 0:
+            lid = min(ready, key=lambda x: position[x])
+            ready.remove(lid)
+            order.append(layersById[lid])
+            for nextId in nextLayerIds[lid]:
+                remaining[nextId] -= 1
+                if remaining[nextId] == 0:
+                    ready.append(nextId)
+        if len(order) != len(trainingPlan):
+            raise ValueError("Plan has a cycle among layers %s." %
+                             str(sorted(lid for lid in remaining if remaining[lid] > 0)))
+        return order
+
+    # Returns [(srcReplicaIdx, dstReplicaIdx, samples), ...] for replicas whose sample ranges overlap.
+    def getOverlaps(self, srcIdx, dstIdx):
+        srcOffsets = self.batchOffsets[srcIdx]
+        dstOffsets = self.batchOffsets[dstIdx]
+        overlaps = []
+        s = 0
+        d = 0
+        while s < len(srcOffsets) - 1 and d < len(dstOffsets) - 1:
+            left = max(srcOffsets[s], dstOffsets[d])
+            right = min(srcOffsets[s+1], dstOffsets[d+1])
+            if right > left:
+                overlaps.append((s, d, right - left))
+            if srcOffsets[s+1] < dstOffsets[d+1]:
+                s += 1
+            else:
+                d += 1
+        return overlaps
+
+
+MAX_CACHED_PLANS = 256 # Per network. Least recently used plans are dropped beyond this.
+compiledPlanCache = weakref.WeakKeyDictionary() # [network] = OrderedDict [(planInJson, useGuidForAcceleratorIds)] = CompiledPlan
+
+# Returns a cached CompiledPlan if the same plan was compiled for the same network recently.
+# With useCache=False, the plan is compiled without touching the cache.
+def compilePlan(trainingPlan, network, useGuidForAcceleratorIds=False, useCache=True):
+    if isinstance(trainingPlan, CompiledPlan):
+        return trainingPlan
+    if not useCache:
+        return CompiledPlan(trainingPlan, network, useGuidForAcceleratorIds)
+    key = (json.dumps(trainingPlan, sort_keys=True), useGuidForAcceleratorIds)
+    plans = compiledPlanCache.setdefault(network, OrderedDict())
+    if key in plans:
+        plans.move_to_end(key)
+        return plans[key]
+    plans[key] = CompiledPlan(trainingPlan, network, useGuidForAcceleratorIds)
+    if len(plans) > MAX_CACHED_PLANS:
+        plans.popitem(last=False)
+    return plans[key]
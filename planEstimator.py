@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2020 MIT
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import sys
+import json
+import numpy as np
+import simulator
+from networkEditor import Simulation
+from networkEditor import buildAwsP3Network
+from profile import Profile
+from planCompiler import compilePlan
+
+# Analytic bounds on the iteration time computed by simulator.simulate(), without
+# running the discrete-event simulation.
+#
+# Every accelerator and every link is a resource that serializes its tasks.
+#  - Lower bound: max(critical path ignoring contention, busiest resource).
+#    Transfers are cut-through, so a link only delays the iteration until its last
+#    transfer has started and delivered; the bound for a link is its load minus the
+#    largest transfer plus the shortest delivery tail.
+#  - Upper bound: critical path + sum of all resource loads. Along the chain of tasks
+#    that determines the finish time, a task only waits while its resource is busy
+#    with other work, so total waiting can't exceed the total load.
+# The upper bound grows with the number of resources, so it rarely prunes on large clusters.
+# findFastest() prunes with the best simulated time instead.
+# All times are in microseconds, same as Simulation.
+class PlanEstimator:
+    def __init__(self, network, profiles, useGuidForAcceleratorIds=False):
+        assert(network.arePathsReady)
+        self.net = network
+        self.profiles = profiles
+        self.useGuidForAcceleratorIds = useGuidForAcceleratorIds
+        self.linkBw = np.array([link.bw for link in network.links], dtype=float)
+        self.costTables = {} # [(model, phase, layerId)] = (batches, computeTimes) with (0, 0) prepended.
+        self.xferCache = {}  # [(src, dst)] = (lastHopBw, [lid, ...], [latency from the hop to dst, ...])
+
+    def getCostTable(self, model, phase, layerId):
+        key = (model, phase, layerId)
+        if key not in self.costTables:
+            batches, times = self.profiles[model].getTable(phase, layerId)
+            batches = np.concatenate(([0.0], batches))
+            times = np.concatenate(([0.0], times))
+            self.costTables[key] = (batches, times)
+        return self.costTables[key]
+
+    # Vectorized equivalent of Profile.getCost() for many local batch sizes at once.
+    def getCosts(self, model, phase, layerId, localBatches, tensorParallel):
+        batches, times = self.getCostTable(model, phase, layerId)
+        assert(np.all(localBatches <= batches[-1]))
+        return np.interp(localBatches, batches, times) * self.profiles[model].computeScale / tensorParallel
+
+    # Contention-free transfer time follows Simulation.run(): every hop adds its latency
+    # (cut-through), and the bandwidth of the final hop determines when data is delivered.
+    def getXferPath(self, src, dst):
+        key = (src, dst)
+        if key not in self.xferCache:
+            lids = self.net.getPath(src, dst)
+            latencies = [self.net.links[lid].lat for lid in lids]
+            tailLatencies = [sum(latencies[i:]) for i in range(len(lids))]
+            self.xferCache[key] = (self.net.links[lids[-1]].bw, lids, tailLatencies)
+        return self.xferCache[key]
+
+    # Step 1. Collect every compute entry of all plans, so profile lookups are done
+    # with one np.interp() call per (model, layer).
+    # Entries are per replica; every tensor-parallel shard of the replica runs the entry's compute time.
+    # Returns computeTimes[phase][entryIdx], computeIndex and (planIdx, guid, entryIdx) of every shard.
+    def collectComputeEntries(self, plans):
+        groups = {} # [(model, layerId, tensorParallel)] = ([entryIdx, ...], [localBatch, ...])
+        entryIdx = 0
+        computeIndex = [] # [planIdx][layerIdx] = first entryIdx of the layer.
+        shardEntries = []
+        shardGuids = []
+        shardPlanIndices = []
+        for planIdx, plan in enumerate(plans):
+            layerIndex = []
+            for idx in range(len(plan)):
+                layerIndex.append(entryIdx)
+                for r, shards in enumerate(plan.shardGuids[idx]):
+                    key = (plan.models[idx][r], plan.layerIds[idx], plan.tensorParallel[idx])
+                    idxs, batches = groups.setdefault(key, ([], []))
+                    idxs.append(entryIdx)
+                    batches.append(plan.localBatches[idx][r])
+                    for aid in shards:
+                        shardEntries.append(entryIdx)
+                        shardGuids.append(aid)
+                        shardPlanIndices.append(planIdx)
+                    entryIdx += 1
+            computeIndex.append(layerIndex)
+
+        computeTimes = np.zeros((2, entryIdx))
+        for (model, layerId, tensorParallel), (idxs, batches) in groups.items():
+            for phase in range(2):
+                computeTimes[phase, idxs] = self.getCosts(model, phase, layerId, np.array(batches, dtype=float),
+                                                          tensorParallel)
+        return computeTimes, computeIndex, (np.array(shardPlanIndices, dtype=int), np.array(shardGuids, dtype=int),
+                                            np.array(shardEntries, dtype=int))
+
+    # Step 2. Walk one plan in forward & backward order for the contention-free critical path,
+    # and record link usage for the load vector.
+    # xferHops gets (lid, xferBytes, tail) for every hop, where tail is the time from the
+    # start of the hop until the data is delivered at the destination.
+    # optimizerLoads gets (guid, optimizerTime) for every optimizer step.
+    def walkPlan(self, plan, computeTimes, layerIndex, xferHops, optimizerLoads):
+        def recordXfer(src, dst, xferBytes):
+            lastHopBw, lids, tailLatencies = self.getXferPath(src, dst)
+            for lid, tailLatency in zip(lids, tailLatencies):
+                xferHops.append((lid, xferBytes, tailLatency + xferBytes / lastHopBw))
+            return xferHops[-len(lids)][2]
+
+        # Same steps as simulator.scheduleAllReduce(). Reductions take no time.
+        def allReduce(guids, xferBytes, ready):
+            n = len(guids)
+            if n == 1 or xferBytes <= 0:
+                return ready
+            for step in range(2 * (n - 1)):
+                arrivals = list(ready) # A reduction also waits for the member's own data.
+                for i in range(n):
+                    j = (i + 1) % n
+                    arrival = ready[i]
+                    if guids[i] != guids[j]: # Like Simulation.scheduleXfer(), a self-transfer is free.
+                        arrival += recordXfer(guids[i], guids[j], xferBytes / n)
+                    arrivals[j] = max(arrivals[j], arrival)
+                ready = arrivals
+            return ready
+
+        # Returns ([replicaIdx][shard] = time when the shard's output is ready,
+        #          [replicaIdx][shard] = time when the shard's compute finishes).
+        def finishTimes(idx, inputs, srcFinish, initialReady, bytesPerSample, phase):
+            finish = []
+            computeFinish = []
+            for r, shards in enumerate(plan.shardGuids[idx]):
+                computeTime = computeTimes[phase][layerIndex[idx] + r]
+                if phase == 1 and plan.recompute[idx]:
+                    computeTime += computeTimes[0][layerIndex[idx] + r]
+                shardFinish = []
+                for j, aid in enumerate(shards):
+                    ready = initialReady[r][j] if initialReady else 0
+                    for srcIdx, srcReplica, xferBytes in inputs[idx][r]:
+                        srcShards = plan.shardGuids[srcIdx][srcReplica]
+                        k = j % len(srcShards)
+                        arrival = srcFinish[srcIdx][srcReplica][k]
+                        if srcShards[k] != aid and xferBytes > 0:
+                            arrival += recordXfer(srcShards[k], aid, xferBytes)
+                        ready = max(ready, arrival)
+                    shardFinish.append(ready + computeTime)
+                computeFinish.append(shardFinish)
+                finish.append(allReduce(shards, plan.localBatches[idx][r] * bytesPerSample[idx], shardFinish))
+            return finish, computeFinish
+
+        fwdFinish = [None] * len(plan) # [layerIdx][replicaIdx][shard] = finish time
+        for idx in range(len(plan)):
+            fwdFinish[idx], _ = finishTimes(idx, plan.fwdInputs, fwdFinish, None, plan.outputBytesPerSample, 0)
+        bwdFinish = [None] * len(plan)
+        gradientFinish = [None] * len(plan)
+        for idx in reversed(range(len(plan))):
+            bwdFinish[idx], gradientFinish[idx] = finishTimes(idx, plan.bwdInputs, bwdFinish,
+                                                              fwdFinish[idx] if idx == plan.lastLayerIdx else None,
+                                                              plan.inputBytesPerSample, 1)
+        criticalPath = max(max(max(shards) for shards in finish[idx]) for finish in [fwdFinish, bwdFinish] for idx in range(len(plan)))
+
+        # Same as step 3 of simulator.buildTaskGraph().
+        for idx in range(len(plan)):
+            shardBytes = plan.modelBytes[idx] / plan.tensorParallel[idx]
+            if shardBytes <= 0:
+                continue
+            for j in range(plan.tensorParallel[idx]):
+                guids = [shards[j] for shards in plan.shardGuids[idx]]
+                synced = allReduce(guids, shardBytes, [shards[j] for shards in gradientFinish[idx]])
+                for aid, syncedTime in zip(guids, synced):
+                    optimizerTime = shardBytes / self.net.elements[aid].optimizerBw
+                    optimizerLoads.append((aid, optimizerTime))
+                    criticalPath = max(criticalPath, syncedTime + optimizerTime)
+        return criticalPath
+
+    # Returns numpy array of shape (len(trainingPlans), 2): [lowerBound, upperBound] per plan.
+    def estimateMany(self, trainingPlans):
+        plans = [compilePlan(p, self.net, self.useGuidForAcceleratorIds) for p in trainingPlans]
+        computeTimes, computeIndex, (planIndices, guids, entries) = self.collectComputeEntries(plans)
+        recompute = np.array([plan.recompute[idx] for plan in plans for idx in range(len(plan))
+                              for r in range(len(plan.guids[idx]))], dtype=float)
+        entryLoads = computeTimes[0] * (1 + recompute) + computeTimes[1] # forward (+ recompute) + backward
+        accelLoads = np.zeros((len(trainingPlans), len(self.net.elements)))
+        np.add.at(accelLoads, (planIndices, guids), entryLoads[entries])
+
+        numLinks = len(self.net.links)
+        linkLoads = np.zeros((len(trainingPlans), numLinks))
+        linkMaxXfer = np.zeros((len(trainingPlans), numLinks))
+        linkMinTail = np.full((len(trainingPlans), numLinks), np.inf)
+        criticalPath = np.zeros(len(trainingPlans))
+        for planIdx, plan in enumerate(plans):
+            xferHops = []
+            optimizerLoads = []
+            criticalPath[planIdx] = self.walkPlan(plan, computeTimes, computeIndex[planIdx], xferHops, optimizerLoads)
+            for aid, optimizerTime in optimizerLoads:
+                accelLoads[planIdx, aid] += optimizerTime
+            if len(xferHops) > 0:
+                lids, xferBytes, tails = (np.array(x) for x in zip(*xferHops))
+                lids = lids.astype(int)
+                xferTimes = xferBytes / self.linkBw[lids]
+                np.add.at(linkLoads[planIdx], lids, xferTimes)
+                np.maximum.at(linkMaxXfer[planIdx], lids, xferTimes)
+                np.minimum.at(linkMinTail[planIdx], lids, tails)
+
+        linkBounds = np.where(linkLoads > 0, linkLoads - linkMaxXfer + linkMinTail, 0)
+        lower = np.maximum(criticalPath, np.maximum(accelLoads.max(axis=1), linkBounds.max(axis=1, initial=0)))
+        upper = criticalPath + accelLoads.sum(axis=1) + linkLoads.sum(axis=1)
+        return np.stack([lower, upper], axis=1)
+
+    def estimate(self, trainingPlan):
+        bounds = self.estimateMany([trainingPlan])[0]
+        return bounds[0], bounds[1]
+
+    # Returns indices of plans that may still be the fastest, i.e. whose lower bound
+    # doesn't exceed the best upper bound. Only these need a full simulation.
+    def filterDominated(self, trainingPlans):
+        bounds = self.estimateMany(trainingPlans)
+        bestUpper = bounds[:, 1].min()
+        return [i for i in range(len(trainingPlans)) if bounds[i, 0] <= bestUpper]
+
+    # Simulates plans in increasing order of their lower bound, and skips every plan whose lower
+    # bound exceeds the best simulated time so far.
+    # Returns (index of the fastest plan, [planIdx] = simulated iteration time or None if skipped).
+    # Checks that every simulated time lies within the plan's bounds (from estimateMany() if not given).
+    def findFastest(self, trainingPlans, bounds=None, **simulateOptions):
+        if bounds is None:
+            bounds = self.estimateMany(trainingPlans)
+        times = [None] * len(trainingPlans)
+        bestIdx = None
+        for i in np.argsort(bounds[:, 0], kind="stable"):
+            if bestIdx is not None and bounds[i, 0] > times[bestIdx]:
+                break # Remaining plans have even larger lower bounds.
+            result = simulator.simulate(trainingPlans[i], self.net, self.profiles, self.useGuidForAcceleratorIds,
+                                        **simulateOptions)
+            times[i] = result["iterationTime"]
+            slack = 1e-9 * times[i]
+            assert bounds[i, 0] <= times[i] + slack <= bounds[i, 1] + 2 * slack, \
+                "plan %d: simulated %f outside bounds [%f, %f]" % (i, times[i], bounds[i, 0], bounds[i, 1])
+            if bestIdx is None or times[i] < times[bestIdx]:
+                bestIdx = i
+        return bestIdx, times
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Wrong number of args! Usage:")
+        print("./planEstimator.py <path_to_profile> <path_to_plan> [<path_to_plan> ...]")
+        return
+
+    net = buildAwsP3Network(1, 4, 10, 10)
+    profiles = {"V100": Profile(sys.argv[1])} # TODO: support heterogeneous GPUs
+    trainingPlans = []
+    for path in sys.argv[2:]:
+        with open(path) as f:
+            trainingPlans.append(json.load(f))
+
+    simulator.VERBOSE = False
+    Simulation.VERBOSE = False
+    estimator = PlanEstimator(net, profiles)
+    bounds = estimator.estimateMany(trainingPlans)
+    bestIdx, times = estimator.findFastest(trainingPlans, bounds)
+    print("#  lowerBound(ms)  upperBound(ms)  simulated(ms)  plan")
+    for i, path in enumerate(sys.argv[2:]):
+        print("%15.3f %15.3f %14s  %s%s" % (bounds[i, 0] / 1000, bounds[i, 1] / 1000,
+                                            "pruned" if times[i] is None else "%.3f" % (times[i] / 1000),
+                                            path, "  (fastest)" if i == bestIdx else ""))
+
+if __name__ == "__main__":
+    main()
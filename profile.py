@@ -14,6 +14,7 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import hashlib
 import json
 
 class Profile:
@@ -22,9 +23,40 @@ class Profile:
             self.datapoint = json.load(open(jsonFilepath))
         else:
             self.datapoint = [{}, {}] # [<dict> layerId] = [(localBatch, computeTime), ...]
+        self.computeScale = 1.0 # Multiplies every compute time. Set by calibration (see networkEditor.applyCalibration).
+        self.table = None       # sharedTables.ProfileTable. If attached, it replaces datapoint.
+        self.contentKey = None  # Cached by getContentKey(). Set to None after modifying datapoint directly.
+
+    # Uses read-only datapoints in shared memory (see sharedTables.py) instead of datapoint.
+    def attachTable(self, table):
+        self.table = table
+        self.datapoint = None
+        self.contentKey = None
+
+    # Datapoints can't change once a read-only table is attached.
+    def checkWritable(self):
+        if self.table is not None:
+            raise ValueError("Profile has a read-only table attached (see attachTable()); it can't be modified.")
+
+    # Returns (localBatches, computeTimes) of the layer's datapoints, sorted by localBatch.
+    def getTable(self, phase, layerIdInt):
+        if self.table is not None:
+            return self.table.getTable(phase, layerIdInt)
+        points = self.datapoint[phase][str(layerIdInt)]
+        return [p[0] for p in points], [p[1] for p in points]
+
+    # Hash of the datapoints, computed once until they change. The same whether or not a table is attached.
+    def getContentKey(self):
+        if self.table is not None:
+            return self.table.digest
+        if self.contentKey is None:
+            self.contentKey = hashlib.sha256(json.dumps(self.datapoint, sort_keys=True).encode()).hexdigest()
+        return self.contentKey
         
     def addDatapoint(self, layerIdInt, localBatch, computeTimes, alreadySorted = False):
+        self.checkWritable()
         layerId = str(layerIdInt)
+        self.contentKey = None
         if layerId not in self.datapoint[0]:
             for i in range(len(self.datapoint)):
                 self.datapoint[i][layerId] = []
@@ -33,8 +65,23 @@ class Profile:
             self.datapoint[i][layerId].append((localBatch, computeTimes[i]))
             if not alreadySorted:
                 self.datapoint[i][layerId].sort() # TODO: make it efficient when performance matters.
-        
-    def getCost(self, phase, layerIdInt, localBatch):
+
+    # Replaces all datapoints of a layer at once. computeTimes[phase][i] is the time for localBatches[i].
+    # Sorts only once, so use this instead of addDatapoint() when loading many batch sizes.
+    def setDatapoints(self, layerIdInt, localBatches, computeTimes):
+        self.checkWritable()
+        layerId = str(layerIdInt)
+        self.contentKey = None
+        assert(len(self.datapoint) == len(computeTimes))
+        order = sorted(range(len(localBatches)), key=lambda i: localBatches[i])
+        for i in range(len(self.datapoint)):
+            assert(len(computeTimes[i]) == len(localBatches))
+            self.datapoint[i][layerId] = [(localBatches[j], computeTimes[i][j]) for j in order]
+
+    # With tensorParallel > 1, the layer is sharded by its weights and each shard does 1/tensorParallel of the work.
+    def getCost(self, phase, layerIdInt, localBatch, tensorParallel = 1):
+        if self.table is not None:
+            return self.table.getCost(phase, layerIdInt, localBatch) * self.computeScale / tensorParallel
         layerId = str(layerIdInt)
         
         batch_a = 0
@@ -53,4 +100,5 @@ class Profile:
         
         assert(batch_b > 0)
         
-        return (localBatch - batch_a + 0.0) * (compTime_b - compTime_a + 0.0) / (batch_b - batch_a + 0.0) + compTime_a
+        cost = (localBatch - batch_a + 0.0) * (compTime_b - compTime_a + 0.0) / (batch_b - batch_a + 0.0) + compTime_a
+        return cost * self.computeScale / tensorParallel
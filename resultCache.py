@@ -0,0 +1,142 @@
+# Copyright (c) 2020 MIT
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import hashlib
+import json
+import os
+import tempfile
+from planCompiler import CompiledPlan
+try:
+    import fcntl
+except ImportError: # Not available on Windows. Eviction is then not serialized among processes.
+    fcntl = None
+
+# Bump this whenever simulate() changes its results, so stale entries aren't reused.
+CACHE_VERSION = 2
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+EVICT_TO_FRACTION = 0.9     # Eviction frees space down to this fraction of maxBytes.
+RESCAN_INTERVAL = 1000      # Puts between rescans of the directory, to count entries of other processes.
+
+# On-disk cache of simulate() results, shared by any number of processes.
+# Entries are keyed by a hash of the plan, network configuration, profiles and options.
+#  - Writes go to a temp file that is atomically renamed, so readers never see partial entries.
+#  - Every hit refreshes the entry's mtime; when the cache exceeds maxBytes, the least
+#    recently used entries are removed under an exclusive lock.
+#  - Each process tracks the total size from its own puts and only scans the directory when that
+#    exceeds maxBytes or every RESCAN_INTERVAL puts, so a put doesn't cost a walk over all entries.
+class ResultCache:
+    def __init__(self, directory, maxBytes = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.totalBytes = None      # Estimated size of all entries. None until the first put scans the directory.
+        self.putsSinceScan = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def makeKey(trainingPlan, network, profiles, **options):
+        if isinstance(trainingPlan, CompiledPlan):
+            planInJson = trainingPlan.planInJson
+        else:
+            planInJson = json.dumps(trainingPlan, sort_keys=True)
+        h = hashlib.sha256()
+        h.update(("v%d\n" % CACHE_VERSION).encode())
+        h.update(planInJson.encode())
+        h.update(network.getContentKey().encode())
+        for model in sorted(profiles):
+            h.update(model.encode())
+            h.update(profiles[model].getContentKey().encode())
+            h.update(repr(profiles[model].computeScale).encode())
+        h.update(json.dumps(options, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    # Returns the cached result, or None.
+    def get(self, key):
+        path = self.getPath(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            os.utime(path) # Mark as recently used.
+        except (OSError, ValueError): # Missing, evicted by another process meanwhile, or corrupted.
+            return None
+        return result
+
+    def put(self, key, result):
+        path = self.getPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(result, f)
+                size = f.tell()
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.unlink(tmpPath)
+            raise
+        self.putsSinceScan += 1
+        if self.totalBytes is None or self.putsSinceScan >= RESCAN_INTERVAL:
+            self.totalBytes = sum(size for _, size, _ in self.listEntries())
+            self.putsSinceScan = 0
+        else:
+            self.totalBytes += size # Overcounts a replaced entry, which only makes the next scan earlier.
+        if self.totalBytes > self.maxBytes:
+            self.evict()
+
+    def listEntries(self):
+        entries = [] # [(mtime, size, path), ...]
+        for sub in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(subdir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    # If the cache exceeds maxBytes, removes least recently used entries until it fits in
+    # EVICT_TO_FRACTION of maxBytes, so that the following puts don't evict again right away.
+    def evict(self):
+        with open(os.path.join(self.directory, ".lock"), "w") as lockFile:
+            if fcntl:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+            entries = self.listEntries()
+            totalBytes = sum(size for _, size, _ in entries)
+            if totalBytes > self.maxBytes:
+                entries.sort()
+                for mtime, size, path in entries:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                    totalBytes -= size
+                    if totalBytes <= self.maxBytes * EVICT_TO_FRACTION:
+                        break
+            self.totalBytes = totalBytes
+            self.putsSinceScan = 0
+
+    def clear(self):
+        for _, _, path in self.listEntries():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self.totalBytes = 0
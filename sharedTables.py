@@ -0,0 +1,223 @@
+# Copyright (c) 2020 MIT
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import bisect
+import sys
+import numpy as np
+from multiprocessing import shared_memory
+from profile import Profile
+
+# Profile interpolation tables and all-pairs routes as flat arrays in one shared memory block,
+# so that worker processes share a single read-only copy instead of private Python objects.
+#
+#   tables = SharedTables.export(profiles, net)     # in the parent, after net.calcShortestPath().
+#   handle = tables.getHandle()                     # small & picklable; pass to workers.
+#   ...
+#   workerTables = SharedTables.attach(handle)      # in a worker started by multiprocessing.
+#   profiles = workerTables.attachProfiles()
+#   net.attachRoutes(workerTables.getRouteTable())  # net built the same way, without calcShortestPath().
+#   ...
+#   tables.close(); tables.unlink()                 # in the parent, when workers are done.
+#
+# Arrays are exposed both as read-only numpy arrays (for vectorized use) and as typed memoryviews,
+# which are faster than numpy for the scalar lookups of Profile.getCost() and Network.getPath().
+
+ALIGNMENT = 8
+FORMATS = {np.dtype(np.int32): "i", np.dtype(np.int64): "q", np.dtype(np.float64): "d"}
+
+class TableMemory(shared_memory.SharedMemory):
+    # Arrays usually refer to the memory until the interpreter exits, when closing fails harmlessly.
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass
+
+def openSharedMemory(name):
+    if sys.version_info >= (3, 13):
+        return TableMemory(name=name, track=False)
+    # Workers started by multiprocessing share the owner's resource tracker, so this registers nothing new.
+    return TableMemory(name=name)
+
+# Datapoints of a Profile. For layer i of phase p, points are at [offsets[p, i], offsets[p, i+1]).
+class ProfileTable:
+    def __init__(self, tables, model):
+        prefix = "profile:%s:" % model
+        self.layerIds = tables.arrays[prefix + "layerIds"]
+        self.offsets = tables.arrays[prefix + "offsets"]
+        self.batches = tables.arrays[prefix + "batches"]
+        self.times = tables.arrays[prefix + "times"]
+        self.offsetsView = tables.views[prefix + "offsets"]
+        self.batchesView = tables.views[prefix + "batches"]
+        self.timesView = tables.views[prefix + "times"]
+        self.stride = len(self.layerIds) + 1
+        self.layerIndex = {int(lid): i for i, lid in enumerate(self.layerIds)}
+        self.digest = tables.meta["profileDigests"][model] # Hash of the exported datapoints.
+
+    # Returns (batches, times) of the layer's datapoints, sorted by batch.
+    def getTable(self, phase, layerIdInt):
+        base = phase * self.stride + self.layerIndex[int(layerIdInt)]
+        lo, hi = self.offsets[base], self.offsets[base + 1]
+        return self.batches[lo:hi], self.times[lo:hi]
+
+    # Same interpolation as Profile.getCost(), before scaling.
+    def getCost(self, phase, layerIdInt, localBatch):
+        base = phase * self.stride + self.layerIndex[int(layerIdInt)]
+        lo = self.offsetsView[base]
+        hi = self.offsetsView[base + 1]
+        batches = self.batchesView
+        j = bisect.bisect_left(batches, localBatch, lo, hi)
+        assert(j < hi)
+        batch_b = batches[j]
+        compTime_b = self.timesView[j]
+        if j == lo:
+            batch_a = 0
+            compTime_a = 0
+        else:
+            batch_a = batches[j - 1]
+            compTime_a = self.timesView[j - 1]
+        return (localBatch - batch_a + 0.0) * (compTime_b - compTime_a + 0.0) / (batch_b - batch_a + 0.0) + compTime_a
+
+# Routes of a Network. For a pair at src * elementCount + dst, nextHop is the guid of the first hop
+# and linkId the first link of the path. -1 where there's no path.
+class RouteTable:
+    def __init__(self, tables):
+        self.nextHop = tables.arrays["route:nextHop"]
+        self.linkId = tables.arrays["route:linkId"]
+        self.nextHopView = tables.views["route:nextHop"]
+        self.linkIdView = tables.views["route:linkId"]
+        self.elementCount = tables.meta["elementCount"]
+        self.linkCount = tables.meta["linkCount"]
+
+    # Returns [linkId, ...] along the path from src to dst.
+    def getPath(self, src, dst):
+        n = self.elementCount
+        lids = []
+        node = src
+        while node != dst:
+            lid = self.linkIdView[node * n + dst]
+            assert(lid >= 0)
+            lids.append(lid)
+            node = self.nextHopView[node * n + dst]
+        return lids
+
+class SharedTables:
+    def __init__(self, shm, layout, meta, owner):
+        self.shm = shm
+        self.layout = layout    # [name] = (offset, dtype, shape)
+        self.meta = meta
+        self.owner = owner
+        self.arrays = {}        # [name] = read-only np.ndarray
+        self.views = {}         # [name] = read-only 1-d typed memoryview
+        buf = shm.buf.toreadonly()
+        for name, (offset, dtype, shape) in layout.items():
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            self.views[name] = buf[offset:offset + nbytes].cast(FORMATS[dtype])
+            self.arrays[name] = np.frombuffer(self.views[name], dtype=dtype).reshape(shape)
+
+    @staticmethod
+    def export(profiles = None, network = None):
+        arrays = {}
+        meta = {"profileDigests": {}}
+        for model, profile in (profiles or {}).items():
+            arrays.update(SharedTables.flattenProfile(model, profile))
+            meta["profileDigests"][model] = profile.getContentKey()
+        if network is not None:
+            arrays.update(SharedTables.flattenRoutes(network))
+            meta["elementCount"] = len(network.elements)
+            meta["linkCount"] = len(network.links)
+
+        layout = {}
+        size = 0
+        for name, array in arrays.items():
+            layout[name] = (size, array.dtype.str, array.shape)
+            size += (array.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        shm = TableMemory(create=True, size=max(size, 1))
+        for name, array in arrays.items():
+            offset = layout[name][0]
+            shm.buf[offset:offset + array.nbytes] = array.tobytes()
+        return SharedTables(shm, layout, meta, True)
+
+    @staticmethod
+    def flattenProfile(model, profile):
+        layerKeys = sorted(profile.datapoint[0], key=int)
+        phases = len(profile.datapoint)
+        offsets = np.zeros((phases, len(layerKeys) + 1), dtype=np.int64)
+        batches = []
+        times = []
+        for phase in range(phases):
+            for i, layerKey in enumerate(layerKeys):
+                points = profile.datapoint[phase][layerKey]
+                offsets[phase, i] = len(batches)
+                batches += [p[0] for p in points]
+                times += [p[1] for p in points]
+            offsets[phase, len(layerKeys)] = len(batches)
+        prefix = "profile:%s:" % model
+        return {prefix + "layerIds": np.array([int(k) for k in layerKeys], dtype=np.int64),
+                prefix + "offsets": offsets.reshape(-1),
+                prefix + "batches": np.array(batches, dtype=np.float64),
+                prefix + "times": np.array(times, dtype=np.float64)}
+
+    @staticmethod
+    def flattenRoutes(network):
+        assert(network.arePathsReady)
+        n = len(network.elements)
+        nextHop = np.full(n * n, -1, dtype=np.int32)
+        linkId = np.full(n * n, -1, dtype=np.int32)
+        for src in range(n):
+            paths = network.pathFromSrc[src]
+            if len(paths) == 0:
+                continue
+            dsts = np.fromiter(paths.keys(), dtype=np.int64, count=len(paths))
+            hops = np.fromiter((path[0] for path in paths.values()), dtype=np.int64, count=len(paths))
+            firstLinks = np.full(n, -1, dtype=np.int32)
+            for neighborGuid, link in network.linkFromSrc[src].items():
+                firstLinks[neighborGuid] = link.lid
+            nextHop[src * n + dsts] = hops
+            linkId[src * n + dsts] = firstLinks[hops]
+        return {"route:nextHop": nextHop, "route:linkId": linkId}
+
+    def getHandle(self):
+        return {"name": self.shm.name, "layout": self.layout, "meta": self.meta}
+
+    @staticmethod
+    def attach(handle):
+        return SharedTables(openSharedMemory(handle["name"]), handle["layout"], handle["meta"], False)
+
+    def getProfileTable(self, model):
+        return ProfileTable(self, model)
+
+    def getRouteTable(self):
+        return RouteTable(self)
+
+    # Returns [model] = Profile backed by the shared tables.
+    def attachProfiles(self):
+        profiles = {}
+        for model in self.meta["profileDigests"]:
+            profiles[model] = Profile()
+            profiles[model].attachTable(self.getProfileTable(model))
+        return profiles
+
+    # Every ProfileTable, RouteTable and array from these tables must be dropped before closing.
+    def close(self):
+        self.arrays = {}
+        for view in self.views.values():
+            view.release()
+        self.views = {}
+        self.shm.close()
+
+    def unlink(self):
+        assert(self.owner)
+        self.shm.unlink()
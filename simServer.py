@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2020 MIT
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import signal
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import simulator
+from simulator import simulate
+from profile import Profile
+from networkEditor import Simulation
+from networkEditor import buildNetworkFromConfig
+from resultCache import ResultCache
+
+# Long-lived simulation service. Worker processes keep profiles, networks and compiled
+# plans in memory, so a query only pays for the simulation itself.
+#
+# Usage:
+#   ./simServer.py --port 8080 --workers 4 --profile V100=profile_pipedream/P100/profile.json \
+#                  --network simpleNet.json
+#
+# Endpoints (JSON in, JSON out):
+#   GET  /health
+#   POST /simulate  {"plan": [...] or "planPath": "...",
+#                    "network": {...} (optional; see networkEditor.buildNetworkFromConfig),
+#                    "profiles": {"V100": "path/to/profile.json"} (optional),
+#                    "useGuidForAcceleratorIds": false (optional)}
+#                   -> the result of simulator.simulate()
+#   POST /batch     {"requests": [<simulate request>, ...]}
+#                   -> {"results": [<result or {"error": "..."}>, ...]} in the same order.
+#                   Identical requests are simulated once, and the rest is split evenly among workers.
+
+MAX_BODY_BYTES = 256 * 1024 * 1024
+MAX_CACHED_ENTRIES = 64 # Per kind (profiles, networks, plans) in each worker. Least recently used are dropped.
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 431: "Request Header Fields Too Large", 500: "Internal Server Error"}
+
+##########################################################################
+# Worker side. Runs in each worker process.
+##########################################################################
+class WorkerState:
+    def __init__(self, defaultProfilePaths, defaultNetworkConfig, cacheDir):
+        self.defaultProfilePaths = defaultProfilePaths  # [model] = path
+        self.defaultNetworkConfig = defaultNetworkConfig
+        # LRU caches of at most MAX_CACHED_ENTRIES each. File-backed entries are reloaded when the file's mtime changes.
+        self.profiles = OrderedDict()  # [path] = (mtime, Profile)
+        self.networks = OrderedDict()  # [canonical JSON of network config] = Network. compilePlan() caches plans per network.
+        self.plans = OrderedDict()     # [planPath] = (mtime, trainingPlan)
+        self.cache = ResultCache(cacheDir) if cacheDir else None
+
+    # Returns cache[key], calling load() if it's missing.
+    @staticmethod
+    def lookup(cache, key, load):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        cache[key] = load()
+        if len(cache) > MAX_CACHED_ENTRIES:
+            cache.popitem(last=False)
+        return cache[key]
+
+    # Same as lookup(), but for the contents of a file. Reloads it if the file changed since.
+    def lookupFile(self, cache, path, load):
+        mtime = os.stat(path).st_mtime_ns
+        if path in cache and cache[path][0] != mtime:
+            del cache[path]
+        return self.lookup(cache, path, lambda: (mtime, load(path)))[1]
+
+    def getProfile(self, path):
+        return self.lookupFile(self.profiles, path, Profile)
+
+    def getNetwork(self, config):
+        if config is None:
+            config = self.defaultNetworkConfig
+        if config is None:
+            raise ValueError("Request has no network, and the server has no default network.")
+        return self.lookup(self.networks, json.dumps(config, sort_keys=True), lambda: buildNetworkFromConfig(config))
+
+    def getPlan(self, request):
+        if "plan" in request:
+            return request["plan"]
+        if "planPath" in request:
+            return self.lookupFile(self.plans, request["planPath"], loadJson)
+        raise ValueError("Request has neither plan nor planPath.")
+
+    def run(self, request):
+        paths = request.get("profiles", self.defaultProfilePaths)
+        profiles = {model: self.getProfile(path) for model, path in paths.items()}
+        return simulate(self.getPlan(request), self.getNetwork(request.get("network")), profiles,
+                        request.get("useGuidForAcceleratorIds", False), cache=self.cache)
+
+def loadJson(path):
+    with open(path) as f:
+        return json.load(f)
+
+workerState = None
+
+def initWorker(defaultProfilePaths, defaultNetworkConfig, cacheDir):
+    global workerState
+    simulator.VERBOSE = False
+    Simulation.VERBOSE = False
+    workerState = WorkerState(defaultProfilePaths, defaultNetworkConfig, cacheDir)
+
+# Runs requests one by one. A failed request yields {"error": ...} instead of failing the others.
+def runRequests(requests):
+    results = []
+    for request in requests:
+        try:
+            results.append(workerState.run(request))
+        except Exception as e:
+            results.append({"error": "%s: %s" % (type(e).__name__, e)})
+    return results
+
+##########################################################################
+# Server side. Runs the event loop.
+##########################################################################
+class SimServer:
+    VERBOSE = False
+
+    def __init__(self, workers = 1, defaultProfilePaths = None, defaultNetworkConfig = None, cacheDir = None):
+        self.workers = max(1, workers)
+        initArgs = (defaultProfilePaths or {}, defaultNetworkConfig, cacheDir)
+        if workers > 0:
+            # Spawned rather than forked, so workers don't inherit the listening socket.
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=initWorker, initargs=initArgs)
+        else: # In-process, mostly for debugging.
+            self.executor = ThreadPoolExecutor(1, initializer=initWorker, initargs=initArgs)
+
+    async def runBatch(self, requests):
+        loop = asyncio.get_running_loop()
+        keys = [json.dumps(request, sort_keys=True) for request in requests]
+        uniqueKeys = list(dict.fromkeys(keys))
+        uniqueRequests = [json.loads(key) for key in uniqueKeys]
+        chunkSize = max(1, math.ceil(len(uniqueRequests) / self.workers))
+        chunks = [uniqueRequests[i:i + chunkSize] for i in range(0, len(uniqueRequests), chunkSize)]
+        chunkResults = await asyncio.gather(*[loop.run_in_executor(self.executor, runRequests, chunk)
+                                              for chunk in chunks])
+        resultByKey = {}
+        for chunk, results in zip(chunks, chunkResults):
+            for request, result in zip(chunk, results):
+                resultByKey[json.dumps(request, sort_keys=True)] = result
+        return [resultByKey[key] for key in keys]
+
+    async def route(self, method, path, body):
+        if path == "/health":
+            return 200, {"status": "ok", "workers": self.workers}
+        if path not in ("/simulate", "/batch"):
+            return 404, {"error": "Unknown path %s." % path}
+        if method != "POST":
+            return 405, {"error": "%s only accepts POST." % path}
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            return 400, {"error": "Invalid JSON: %s" % e}
+        if path == "/simulate":
+            result = (await self.runBatch([request]))[0]
+            return (400 if "error" in result else 200), result
+        if not isinstance(request, dict) or not isinstance(request.get("requests"), list):
+            return 400, {"error": "/batch expects {\"requests\": [...]}."}
+        return 200, {"results": await self.runBatch(request["requests"])}
+
+    async def handleConnection(self, reader, writer):
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+                parts = requestLine.decode("latin-1").split()
+                if len(parts) != 3:
+                    await self.respond(writer, 400, {"error": "Malformed request line."}, False)
+                    break
+                method, path, version = parts
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keepAlive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                try:
+                    length = int(headers.get("content-length", 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.respond(writer, 400, {"error": "Invalid Content-Length."}, False)
+                    break
+                if length > MAX_BODY_BYTES:
+                    await self.respond(writer, 413, {"error": "Body is too large."}, False)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b""
+                try:
+                    status, response = await self.route(method, path.split("?")[0], body)
+                except Exception as e:
+                    status, response = 500, {"error": "%s: %s" % (type(e).__name__, e)}
+                if self.VERBOSE:
+                    print("%s %s -> %d" % (method, path, status))
+                await self.respond(writer, status, response, keepAlive)
+                if not keepAlive:
+                    break
+        except ValueError: # A request or header line longer than the stream's limit.
+            try:
+                await self.respond(writer, 431, {"error": "Request line or header is too long."}, False)
+            except ConnectionError:
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def respond(writer, status, response, keepAlive):
+        body = json.dumps(response).encode()
+        header = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % \
+                 (status, HTTP_REASONS[status], len(body), "keep-alive" if keepAlive else "close")
+        writer.write(header.encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handleConnection, host, port)
+        print("Serving on http://%s:%d with %d workers" % (host, port, self.workers))
+        async with server:
+            await server.serve_forever()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves simulations over HTTP with warm state.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes; 0 runs simulations in-process.")
+    parser.add_argument("--profile", action="append", default=[], metavar="MODEL=PATH",
+                        help="default profile for an accelerator model. Can be repeated.")
+    parser.add_argument("--network", help="default network config file (JSON).")
+    parser.add_argument("--cache-dir", help="directory of an on-disk result cache shared by workers.")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    defaultProfilePaths = {}
+    for entry in args.profile:
+        model, _, path = entry.partition("=")
+        defaultProfilePaths[model] = path
+    defaultNetworkConfig = None
+    if args.network:
+        with open(args.network) as f:
+            defaultNetworkConfig = json.load(f)
+
+    SimServer.VERBOSE = args.verbose
+    server = SimServer(args.workers, defaultProfilePaths, defaultNetworkConfig, args.cache_dir)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
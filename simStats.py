@@ -0,0 +1,89 @@
+# Copyright (c) 2020 MIT
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR(S) DISCLAIM ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL AUTHORS BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import json
+import time
+from contextlib import contextmanager
+
+# Self-profiling record of the simulator. Instrumentation is opt-in:
+#   stats = SimStats()
+#   Network.stats = stats           # records calcShortestPath() of networks built afterwards.
+#   simulate(plan, net, profiles, stats=stats)
+# The fields accumulate over every run recorded into the same SimStats; simulate() reports
+# the numbers of its own run (see startRun() & endRun()).
+# Code paths check "stats is not None" only, so there's no cost when disabled.
+class SimStats:
+    def __init__(self, dumpPath = None):
+        self.dumpPath = dumpPath    # If set, simulate() appends the stats of each run to this file (one JSON per line).
+        self.phaseSeconds = {}      # [phase] = accumulated wall time in seconds.
+        self.counters = {}          # [name] = count
+        self.peakHeapSize = 0
+
+    @contextmanager
+    def timePhase(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(phase, time.perf_counter() - start)
+
+    def addTime(self, phase, seconds):
+        self.phaseSeconds[phase] = self.phaseSeconds.get(phase, 0) + seconds
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def updatePeakHeapSize(self, heapSize):
+        self.peakHeapSize = max(self.peakHeapSize, heapSize)
+
+    # Marks the start of a run. Returns the state to pass to endRun().
+    def startRun(self):
+        start = self.toDict()
+        self.peakHeapSize = 0
+        return start
+
+    # Returns the stats of the run started by startRun(), in the same form as toDict().
+    def endRun(self, before):
+        run = {"phaseSeconds": {phase: seconds - before["phaseSeconds"].get(phase, 0)
+                                for phase, seconds in self.phaseSeconds.items()},
+               "counters": {name: n - before["counters"].get(name, 0)
+                            for name, n in self.counters.items()},
+               "peakHeapSize": self.peakHeapSize}
+        self.peakHeapSize = max(before["peakHeapSize"], self.peakHeapSize)
+        return run
+
+    def reset(self):
+        self.phaseSeconds = {}
+        self.counters = {}
+        self.peakHeapSize = 0
+
+    def toDict(self):
+        return {"phaseSeconds": dict(self.phaseSeconds),
+                "counters": dict(self.counters),
+                "peakHeapSize": self.peakHeapSize}
+
+    # Appends the given stats (default: the accumulated ones) as one JSON line.
+    def dump(self, path = None, statsDict = None):
+        with open(path or self.dumpPath, "a") as f:
+            f.write(json.dumps(statsDict or self.toDict()) + "\n")
+
+    def __str__(self):
+        lines = ["# phase                    seconds"]
+        for phase, seconds in sorted(self.phaseSeconds.items(), key=lambda x: -x[1]):
+            lines.append("%-24s %9.4f" % (phase, seconds))
+        lines.append("# counter                    count")
+        for name, n in sorted(self.counters.items()):
+            lines.append("%-24s %9d" % (name, n))
+        lines.append("%-24s %9d" % ("peakHeapSize", self.peakHeapSize))
+        return "\n".join(lines)
@@ -15,157 +15,219 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 import sys
+import time
 import jsonpickle
 import json
 from networkEditor import Network
 from networkEditor import Simulation
 from networkEditor import buildHostAndGpuNetwork
 from networkEditor import buildAwsP3Network
+from networkEditor import loadCalibration
+from networkEditor import applyCalibration
 from trainingPlanEditor import buildSimplePlan
 from profile import Profile
+from planCompiler import compilePlan
 
-DEBUG = True
-def simulate(trainingPlan, network, profiles, useGuidForAcceleratorIds=False):
-    sim = Simulation(network)
-    layersById = [None] * (len(trainingPlan) + 1)
-    for layer in trainingPlan:
-        layer["nextLayers"] = []
-        layersById[layer["layerId"]] = layer
+VERBOSE = True
 
-    # Step1. Forward Pass
-    computeTasksByLayer = [dict() for x in range(len(trainingPlan) + 1)] # [layerId][acceleratorId] = ComputeTask
-    # computeTaskParams = [] # Used for backward pass.
-    # networkTaskParams = []
-    for layer in trainingPlan: # trainingPlan must be sorted in the DAG order.
-        lid = layer["layerId"]
-        numReplicas = len(layer["assignedAccelerators"])
-        totalBatchSize = sum([assign["localBatch"] for assign in layer["assignedAccelerators"]])
-        samplesAssigned = 0
-        
-        for assignment in layer["assignedAccelerators"]:
-            #    def scheduleCompute(self, acceleratorId, layerId, computeTime, prevXferTasks = []):
-            # aid = assignment['id']
-            if useGuidForAcceleratorIds:
-                aid = assignment['id']
-            else:
-                aid = network.accelerators[assignment['id']-1].guid
-            
-            computeTime = profiles[network.elements[aid].model].getCost(0, lid, assignment['localBatch'])
+# Ring all-reduce of xferBytes among guids. 2*(n-1) steps; in each step every member sends
+# xferBytes/n to the next member, and the received chunk is reduced with the member's own data
+# before it's forwarded, so the reduction waits for both.
+# prevTasks[i] is the task after which guids[i] can start.
+# Returns [task after which guids[i] holds the reduced result, ...].
+def scheduleAllReduce(sim, guids, xferBytes, prevTasks, layerId):
+    n = len(guids)
+    if n == 1 or xferBytes <= 0:
+        return prevTasks
+    readyTasks = list(prevTasks)
+    for step in range(2 * (n - 1)):
+        arrivals = [None] * n
+        for i in range(n):
+            arrivals[(i + 1) % n] = sim.scheduleXfer(guids[i], guids[(i + 1) % n], xferBytes / n, readyTasks[i])
+        # A self-transfer returns the sender's task, which may be the receiver's own.
+        readyTasks = [sim.scheduleCompute(guids[i], layerId, 0, [arrivals[i]] if arrivals[i] is readyTasks[i]
+                                          else [arrivals[i], readyTasks[i]]) for i in range(n)]
+    return readyTasks
+
+# Schedules compute & transfer tasks of one training iteration of the CompiledPlan on sim:
+# forward pass, backward pass, gradient all-reduce among data-parallel replicas and optimizer step.
+# Returns the optimizer tasks.
+def buildTaskGraph(sim, plan, profiles):
+    stats = sim.stats
+    def getCost(phase, idx, r):
+        if stats is None:
+            return profiles[plan.models[idx][r]].getCost(phase, plan.layerIds[idx], plan.localBatches[idx][r],
+                                                         plan.tensorParallel[idx])
+        start = time.perf_counter()
+        cost = profiles[plan.models[idx][r]].getCost(phase, plan.layerIds[idx], plan.localBatches[idx][r],
+                                                     plan.tensorParallel[idx])
+        stats.addTime("profileLookup", time.perf_counter() - start)
+        stats.count("profileLookups")
+        return cost
+
+    # Schedules the compute of every tensor-parallel shard of a replica after its inputs arrive.
+    # Shard j receives its input from shard (j % tensorParallel) of the source replica.
+    # doneTasksByLayer[layerIdx][replicaIdx][shard] = task after which the shard's output is ready.
+    # If recomputeTime is given, the forward pass is recomputed right before the compute.
+    def scheduleShards(idx, r, computeTime, inputs, doneTasksByLayer, extraPrevTasks=None,
+                       memDelta=0, recomputeTime=None):
+        lid = plan.layerIds[idx]
+        shardTasks = []
+        for j, aid in enumerate(plan.shardGuids[idx][r]):
             prevXferTasks = []
-            
-            for prevLayerPtr in layer["prevLayers"]:
-                pl = layersById[prevLayerPtr["LayerId"]]
-                plsa = 0
-                if DEBUG:
-                    totalPrevBatchSize = sum([pla["localBatch"] for pla in pl["assignedAccelerators"]])
-                    assert(totalBatchSize == totalPrevBatchSize)
-                for pla in pl["assignedAccelerators"]:
-                    if useGuidForAcceleratorIds:
-                        plaid = pla['id']
-                    else:
-                        plaid = network.accelerators[pla['id']-1].guid
-
-                    if (plsa < samplesAssigned + assignment['localBatch']) and \
-                            (plsa + pla["localBatch"] > samplesAssigned): # sample ranges overlap.
-                        # Generate xfer task.
-                        left = max(plsa, samplesAssigned)
-                        right = min(plsa + pla["localBatch"], samplesAssigned + assignment['localBatch'])
-                        xferSamples = right - left # TODO: need a unit test to check this calucation is correct..
-                        assert(xferSamples > 0)
-                        xferBytes = xferSamples * prevLayerPtr["InputBytesPerSample"]
-                        # def scheduleXfer(self, src, dst, xferBytes, prevComputeTask = None):
-                        print("Scheduled xfer for %d samples from %d to %d" % (xferSamples, plaid, aid))
-                        prevXferTasks.append(sim.scheduleXfer(plaid, aid, xferBytes,
-                                             computeTasksByLayer[prevLayerPtr["LayerId"]][plaid]))
-                    if plsa >= samplesAssigned + assignment['localBatch']:
-                        break
-                    plsa += pla["localBatch"]
-                
-            samplesAssigned += assignment['localBatch']
-            computeTasksByLayer[lid][aid] = sim.scheduleCompute(aid, lid, computeTime, prevXferTasks)
-        assert(samplesAssigned == totalBatchSize)
-        
-        # Add nextLayer info as we walk through forward pass.
-        # This information is used during scheduling backward pass.
-        for prevLayerPtr in layer["prevLayers"]:
-            prevId = prevLayerPtr["LayerId"]
-            inputBytes = prevLayerPtr["InputBytesPerSample"]
-            layersById[prevId]["nextLayers"].append({"LayerId": lid, "OutputBytesPerSample": inputBytes})
-
-    # There should be only one layer that doesn't have any nextLayer
-    # and it should be the last layer.
-    assert(len(trainingPlan[-1]["nextLayers"]) == 0)
-    for l in trainingPlan[:-1]:
-        assert(len(l["nextLayers"]) > 0)
-    
+            for srcIdx, srcReplica, xferBytes in inputs:
+                srcShards = plan.shardGuids[srcIdx][srcReplica]
+                k = j % len(srcShards)
+                if xferBytes == 0: # Dependency-only edge.
+                    prevXferTasks.append(doneTasksByLayer[srcIdx][srcReplica][k])
+                    continue
+                if VERBOSE:
+                    print("Scheduled xfer for %d bytes from %d to %d" % (xferBytes, srcShards[k], aid))
+                prevXferTasks.append(sim.scheduleXfer(srcShards[k], aid, xferBytes,
+                                     doneTasksByLayer[srcIdx][srcReplica][k]))
+            if extraPrevTasks:
+                prevXferTasks.append(extraPrevTasks[j])
+            if recomputeTime is not None:
+                prevXferTasks = [sim.scheduleCompute(aid, lid, recomputeTime, prevXferTasks, -memDelta)]
+            shardTasks.append(sim.scheduleCompute(aid, lid, computeTime, prevXferTasks, memDelta))
+        return shardTasks
+
+    # Activations stashed from forward pass until backward pass.
+    def stashBytes(idx, r):
+        return plan.localBatches[idx][r] * plan.outputBytesPerSample[idx]
+
+    # Step1. Forward Pass
+    computeTasksByLayer = [[None] * len(guids) for guids in plan.guids] # [layerIdx][replicaIdx][shard] = Task
+    for idx in range(len(plan)): # CompiledPlan is sorted in the DAG order.
+        for r in range(len(plan.guids[idx])):
+            shardTasks = scheduleShards(idx, r, getCost(0, idx, r), plan.fwdInputs[idx][r], computeTasksByLayer,
+                                        memDelta=0 if plan.recompute[idx] else stashBytes(idx, r))
+            # Tensor-parallel shards all-reduce their partial activations.
+            computeTasksByLayer[idx][r] = scheduleAllReduce(sim, plan.shardGuids[idx][r],
+                    plan.localBatches[idx][r] * plan.outputBytesPerSample[idx], shardTasks, plan.layerIds[idx])
+
     # Step2. Backward pass.
-    backComputeTasksByLayer = [dict() for x in range(len(trainingPlan) + 1)] # [layerId][acceleratorId] = ComputeTask
-    for layer in reversed(trainingPlan): # trainingPlan must be sorted in the DAG order.
-        lid = layer["layerId"]
-        numReplicas = len(layer["assignedAccelerators"])
-        totalBatchSize = sum([assign["localBatch"] for assign in layer["assignedAccelerators"]])
-        samplesAssigned = 0
-        
-        for assignment in layer["assignedAccelerators"]:
-            if useGuidForAcceleratorIds:
-                aid = assignment['id']
-            else:
-                aid = network.accelerators[assignment['id']-1].guid
-
-            computeTime = profiles[network.elements[aid].model].getCost(0, lid, assignment['localBatch'])
-            prevXferTasks = []
-            
-            for prevLayerPtr in layer["nextLayers"]: # Next layers are the previous layers during the backward pass.
-                pl = layersById[prevLayerPtr["LayerId"]]
-                plsa = 0
-                if DEBUG:
-                    totalPrevBatchSize = sum([pla["localBatch"] for pla in pl["assignedAccelerators"]])
-                    assert(totalBatchSize == totalPrevBatchSize)
-                for pla in pl["assignedAccelerators"]:
-                    if useGuidForAcceleratorIds:
-                        plaid = pla['id']
-                    else:
-                        plaid = network.accelerators[pla['id']-1].guid
-
-                    if (plsa < samplesAssigned + assignment['localBatch']) and \
-                            (plsa + pla["localBatch"] > samplesAssigned): # sample ranges overlap.
-                        # Generate xfer task.
-                        left = max(plsa, samplesAssigned)
-                        right = min(plsa + pla["localBatch"], samplesAssigned + assignment['localBatch'])
-                        xferSamples = right - left # TODO: need a unit test to check this calucation is correct..
-                        assert(xferSamples > 0)
-                        xferBytes = xferSamples * prevLayerPtr["OutputBytesPerSample"]
-                        # def scheduleXfer(self, src, dst, xferBytes, prevComputeTask = None):
-                        print("Scheduled xfer for %d samples from %d to %d" % (xferSamples, plaid, aid))
-                        prevXferTasks.append(sim.scheduleXfer(plaid, aid, xferBytes,
-                                             backComputeTasksByLayer[prevLayerPtr["LayerId"]][plaid]))
-                    if plsa >= samplesAssigned + assignment['localBatch']:
-                        break
-                    plsa += pla["localBatch"]
-                
-            samplesAssigned += assignment['localBatch']
-            
-            if lid == trainingPlan[-1]['layerId']:
-                prevXferTasks.append(computeTasksByLayer[lid][aid])
-            backComputeTasksByLayer[lid][aid] = sim.scheduleCompute(aid, lid, computeTime, prevXferTasks)
-        assert(samplesAssigned == totalBatchSize)
-
-    # Step 3. parameter sync
-    # Each layer, find accelerator, dependent on backprop calc. perform all-reduce among replicas.
-
-    # TODO: implement backward pass + parameter sync + optimizer cost.
-    # Run forward-pass
-    sim.run()
-    completeTime = max([backComputeTasksByLayer[lid][aid].finishTime for aid in backComputeTasksByLayer[1]])
-    print("Completes at %.1f ms" % (completeTime / 1000))
-    sim.plotNetwork()
+    backComputeTasksByLayer = [[None] * len(guids) for guids in plan.guids] # [layerIdx][replicaIdx][shard] = Task
+    gradientTasksByLayer = [[None] * len(guids) for guids in plan.guids] # [layerIdx][replicaIdx][shard] = ComputeTask
+    for idx in reversed(range(len(plan))):
+        for r in range(len(plan.guids[idx])):
+            # Next layers are the previous layers during the backward pass.
+            shardTasks = scheduleShards(idx, r, getCost(1, idx, r), plan.bwdInputs[idx][r], backComputeTasksByLayer,
+                                        computeTasksByLayer[idx][r] if idx == plan.lastLayerIdx else None,
+                                        memDelta=-stashBytes(idx, r),
+                                        recomputeTime=getCost(0, idx, r) if plan.recompute[idx] else None)
+            gradientTasksByLayer[idx][r] = shardTasks
+            # Tensor-parallel shards all-reduce their partial input gradients.
+            backComputeTasksByLayer[idx][r] = scheduleAllReduce(sim, plan.shardGuids[idx][r],
+                    plan.localBatches[idx][r] * plan.inputBytesPerSample[idx], shardTasks, plan.layerIds[idx])
 
-    #TODO: report the final time? (time when the initial layer gets updated.)
-    #TODO: Run multiple in pipeline.
+    # Step 3. Parameter sync & optimizer step.
+    # The same shard of every data-parallel replica all-reduces its weight gradients, then updates the weights.
+    optimizerTasks = []
+    for idx in range(len(plan)):
+        shardBytes = plan.modelBytes[idx] / plan.tensorParallel[idx]
+        if shardBytes <= 0:
+            continue
+        for j in range(plan.tensorParallel[idx]):
+            guids = [shards[j] for shards in plan.shardGuids[idx]]
+            syncedTasks = scheduleAllReduce(sim, guids, shardBytes,
+                                            [tasks[j] for tasks in gradientTasksByLayer[idx]], plan.layerIds[idx])
+            for aid, syncedTask in zip(guids, syncedTasks):
+                optimizerTime = shardBytes / sim.net.elements[aid].optimizerBw
+                optimizerTasks.append(sim.scheduleCompute(aid, plan.layerIds[idx], optimizerTime, [syncedTask]))
+    return optimizerTasks
+
+# Returns [bytes of weights + peak stashed activations, ...] indexed by accelerator rank.
+def getPeakMemoryBytes(sim, plan):
+    weightBytes = [0] * len(sim.net.elements)
+    for idx in range(len(plan)):
+        # An accelerator listed in several replicas holds one copy of the weights.
+        for aid in {aid for shards in plan.shardGuids[idx] for aid in shards}:
+            weightBytes[aid] += plan.modelBytes[idx] / plan.tensorParallel[idx]
+    return [weightBytes[a.guid] + sim.peakActivationBytes[a.guid] for a in sim.net.accelerators]
 
+# trainingPlan is either the plan in JSON (list of layers) or a CompiledPlan.
+# Returns {"iterationTime": <microseconds>, "peakMemoryBytes": [<bytes> per accelerator]}.
+# If stats (SimStats) is given, per-phase wall times & event counts are accumulated into it,
+# and those of this run are included in the result as "stats".
+# If cache (a ResultCache) is given, a result of an identical earlier run is returned without simulating.
+# scenario (a faultInjection.Scenario) degrades links and accelerators over time during the run.
+# If plotPath is given, the network colored by link utilization and a Gantt chart are saved to
+# <plotPath>_network.png and <plotPath>_gantt.png.
+def simulate(trainingPlan, network, profiles, useGuidForAcceleratorIds=False, plot=False, stats=None, cache=None,
+             scenario=None, plotPath=None):
+    if stats is not None:
+        runStart = stats.startRun()
+    cacheKey = None
+    if cache is not None and not plot and plotPath is None:
+        cacheKey = cache.makeKey(trainingPlan, network, profiles, useGuidForAcceleratorIds=useGuidForAcceleratorIds,
+                                 scenario=None if scenario is None else scenario.toDict())
+        result = cache.get(cacheKey)
+        if result is not None:
+            if VERBOSE:
+                print("Completes at %.1f ms (cached)" % (result["iterationTime"] / 1000))
+            if stats is not None:
+                stats.count("cacheHits")
+                result["stats"] = stats.endRun(runStart)
+                if stats.dumpPath:
+                    stats.dump(statsDict=result["stats"])
+            return result
+        if stats is not None:
+            stats.count("cacheMisses")
 
+    if stats is None:
+        plan = compilePlan(trainingPlan, network, useGuidForAcceleratorIds)
+        sim = Simulation(network, scenario=scenario)
+        buildTaskGraph(sim, plan, profiles)
+    else:
+        with stats.timePhase("planCompile"):
+            plan = compilePlan(trainingPlan, network, useGuidForAcceleratorIds)
+        sim = Simulation(network, stats, scenario)
+        with stats.timePhase("taskGraphBuild"):
+            buildTaskGraph(sim, plan, profiles)
+    sim.run()
+    # Every transfer ends in a compute task, so the last compute task finishes the iteration.
+    completeTime = sim.getCompletionTime()
+    if VERBOSE:
+        print("Completes at %.1f ms" % (completeTime / 1000))
+    if plot:
+        sim.plotNetwork()
+    if plotPath is not None:
+        sim.saveNetworkPlot(plotPath + "_network.png")
+        sim.saveGantt(plotPath + "_gantt.png")
+
+    #TODO: Run multiple in pipeline.
+    result = {"iterationTime": completeTime,
+              "peakMemoryBytes": getPeakMemoryBytes(sim, plan)}
+    if cacheKey is not None:
+        cache.put(cacheKey, result) # Before adding stats, which differ per run.
+    if stats is not None:
+        result["stats"] = stats.endRun(runStart)
+        if stats.dumpPath:
+            stats.dump(statsDict=result["stats"])
+    return result
 
 
+# Every member's result of an all-reduce must depend on the inputs of all members, including
+# members sharing an accelerator.
+def __testAllReduce():
+    net = buildAwsP3Network(1, 4, 10, 10)
+    for ranks in ([0, 1], [0, 1, 2, 3], [0, 1, 1, 2]):
+        guids = [net.accelerators[r].guid for r in ranks]
+        sim = Simulation(net)
+        inputTasks = [sim.scheduleCompute(guid, 1, 100, []) for guid in guids]
+        resultTasks = scheduleAllReduce(sim, guids, 1e6, inputTasks, 1)
+        for i, inputTask in enumerate(inputTasks):
+            reachable = set()
+            stack = [inputTask]
+            while stack:
+                for t in stack.pop().nextTasks:
+                    if id(t) not in reachable:
+                        reachable.add(id(t))
+                        stack.append(t)
+            for j, t in enumerate(resultTasks):
+                assert id(t) in reachable, "all-reduce %s: result of member %d doesn't wait for member %d" % (ranks, j, i)
+    print("__testAllReduce passed.")
 
 def run_example1():
     net = buildHostAndGpuNetwork(2, 2, 10, 10)
@@ -180,22 +242,27 @@ def run_example1():
     # prof_v100.addDatapoint(1, 64, [164, 150])
     # prof_v100.addDatapoint(2, 32, [132, 110])
     profiles = {"V100": prof_v100}
-    simulate(trainingPlan, net, profiles)
+    simulate(trainingPlan, net, profiles, plot=True)
     
 def main():
     if len(sys.argv) == 1:
         run_example1()
-    elif len(sys.argv) == 3:
+    elif sys.argv[1:] == ["--test"]:
+        __testAllReduce()
+    elif len(sys.argv) in (3, 4):
         # net = buildHostAndGpuNetwork(2, 2, 10, 10)
         net = buildAwsP3Network(1, 4, 10, 10)
         profile = Profile(sys.argv[1])
         profiles = {"V100": profile} # TODO: support heterogeneous GPUs
         with open(sys.argv[2]) as f:
             trainingPlan = json.load(f)
-        simulate(trainingPlan, net, profiles, False)
+        if len(sys.argv) == 4:
+            applyCalibration(loadCalibration(sys.argv[3]), net, profiles)
+        simulate(trainingPlan, net, profiles, False, plot=True)
     else:
         print("Wrong number of args! Usage:")
-        print("./simulator <path_to_profile> <path_to_plan>")
+        print("./simulator <path_to_profile> <path_to_plan> [<path_to_calibration>]")
+        print("./simulator --test")
 
 if __name__ == "__main__":
     main()
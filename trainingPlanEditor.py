@@ -20,12 +20,18 @@ class Layer:
     
     # layers = [None] # for tracking all layers.
     
-    def __init__(self, layerId, name, modelBytes, prevLayers, assignedAccelerators = None):
+    def __init__(self, layerId, name, modelBytes, prevLayers, assignedAccelerators = None, tensorParallel = 1,
+                 recompute = False):
         self.layerId = layerId
         self.name = name
         self.modelBytes = modelBytes
         self.prevLayers = prevLayers                    # [(LayerId, inputByteSize), ...]
         self.assignedAccelerators = assignedAccelerators
+        # Megatron-style tensor parallelism. Each entry of assignedAccelerators is a data-parallel replica
+        # whose weights are sharded over accelerators id, id+1, ..., id+tensorParallel-1.
+        self.tensorParallel = tensorParallel
+        # Activation checkpointing. Activations aren't stashed in forward pass, but recomputed before backward pass.
+        self.recompute = recompute
         # self.nextLayers = []                            # [(LayerId, outputByteSize), ...]
         
         # for prev in prevLayers: